@@ -0,0 +1,64 @@
+import os
+
+import pygame as pg
+
+
+# Loads image assets once and keeps scaled variants and composed surfaces (e.g. a fully drawn staff) around.
+# Every entry remembers the mtimes of the files it was built from and is rebuilt only when one of them changes.
+class AssetCache:
+    def __init__(self, assets_dir):
+        self.assets_dir = assets_dir
+        self.images = {}
+        self.scaled_images = {}
+        self.composed = {}
+
+    def path(self, fname):
+        return os.path.join(self.assets_dir, fname)
+
+    def mtime(self, fname):
+        return os.stat(self.path(fname)).st_mtime_ns
+
+    def image(self, fname):
+        mtime = self.mtime(fname)
+        cached = self.images.get(fname)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        image = pg.image.load(self.path(fname))
+        if pg.display.get_surface() is not None:
+            image = image.convert_alpha()
+        self.images[fname] = (mtime, image)
+        return image
+
+    def scaled(self, fname, scale):
+        mtime = self.mtime(fname)
+        cached = self.scaled_images.get((fname, scale))
+        if cached and cached[0] == mtime:
+            return cached[1]
+        image = pg.transform.rotozoom(self.image(fname), 0, scale)
+        self.scaled_images[(fname, scale)] = (mtime, image)
+        return image
+
+    # build(surf) draws the composition onto a surface of the given size, transparent or pre-filled with the opaque
+    # fill color; it's only called again when key changes or one of the asset files it uses does
+    def compose(self, key, size, fnames, build, fill=None):
+        mtimes = tuple(self.mtime(fname) for fname in fnames)
+        cached = self.composed.get((key, size, fill))
+        if cached and cached[0] == mtimes:
+            return cached[1]
+        surf = pg.Surface(size, pg.SRCALPHA)
+        if fill:
+            surf.fill(fill)
+        build(surf)
+        if pg.display.get_surface() is not None:
+            surf = surf.convert() if fill else surf.convert_alpha()
+        self.composed[(key, size, fill)] = (mtimes, surf)
+        return surf
+
+    # composed surfaces are window sized, so they're dropped when the window is resized rather than kept per size
+    def clear_composed(self):
+        self.composed.clear()
+
+    def clear(self):
+        self.images.clear()
+        self.scaled_images.clear()
+        self.composed.clear()
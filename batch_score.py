@@ -0,0 +1,151 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+from collections import Counter
+
+# Must be set before pygame is imported by main
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import main
+import replay
+from main import ERROR_SIDE_EFFECTS, NoteCollisionSideEffect
+
+# Per-process state, built once by init_worker so each session doesn't pay for the staff and lesson compilation
+worker_staff = None
+worker_registry = None
+
+
+def init_worker():
+    global worker_staff, worker_registry
+    worker_staff = main.Staff()
+    worker_registry = main.new_lesson_registry(worker_staff)
+
+
+# Replays one session with the current scoring rules and reduces it to plain counters, so results are cheap to
+# send back to the parent and to merge
+def score_session(fname):
+    try:
+        result = replay.replay_session(replay.read_session(fname), worker_staff, worker_registry)
+    except (OSError, ValueError) as e:
+        return {"session": fname, "error": str(e)}
+
+    side_effects = Counter()
+    note_hits = Counter()
+    note_errors = Counter()
+    for event in result.side_effects:
+        side_effects[event.side_effect.name] += 1
+        if event.side_effect == NoteCollisionSideEffect.SUCCESSFUL_COLLISION_ENEMY:
+            note_hits[event.note_height_id] += 1
+        elif event.side_effect in ERROR_SIDE_EFFECTS:
+            note_errors[event.note_height_id] += 1
+    return {
+        "session": fname,
+        "lesson": result.lesson_name,
+        "frames": result.frames,
+        "score": result.score,
+        "side_effects": side_effects,
+        "stray_shots": side_effects[NoteCollisionSideEffect.PLAYER_MISSED_ALL.name],
+        "note_hits": note_hits,
+        "note_errors": note_errors,
+    }
+
+
+class BatchReport:
+    def __init__(self):
+        self.sessions = 0
+        self.frames = 0
+        self.total_score = 0
+        self.side_effects = Counter()
+        self.note_hits = Counter()
+        self.note_errors = Counter()
+        self.scores = {}
+        self.stray_shots = {}
+        self.failures = {}
+
+    def merge(self, session):
+        if "error" in session:
+            self.failures[session["session"]] = session["error"]
+            return
+        self.sessions += 1
+        self.frames += session["frames"]
+        self.total_score += session["score"]
+        self.side_effects.update(session["side_effects"])
+        self.note_hits.update(session["note_hits"])
+        self.note_errors.update(session["note_errors"])
+        self.scores[session["session"]] = session["score"]
+        self.stray_shots[session["session"]] = session["stray_shots"]
+
+    def note_error_rates(self):
+        res = {}
+        for note_height_id in sorted(set(self.note_hits) | set(self.note_errors)):
+            hits, errors = self.note_hits[note_height_id], self.note_errors[note_height_id]
+            res[note_height_id] = {"hits": hits, "errors": errors, "error_rate": errors / (hits + errors)}
+        return res
+
+    def to_json(self):
+        side_effects = self.side_effects
+        return {
+            "sessions": self.sessions,
+            "frames": self.frames,
+            "total_score": self.total_score,
+            "mean_score": self.total_score / self.sessions if self.sessions else 0,
+            "hits": side_effects[NoteCollisionSideEffect.SUCCESSFUL_COLLISION_ENEMY.name],
+            "misses": side_effects[NoteCollisionSideEffect.PLAYER_MISSED_ALL.name],
+            "got_through": side_effects[NoteCollisionSideEffect.ENEMY_NOTE_GOT_THROUGH.name],
+            "not_first_note": side_effects[NoteCollisionSideEffect.COLLISION_NOT_FIRST_NOTE.name],
+            "side_effects": dict(side_effects),
+            "notes": self.note_error_rates(),
+            "scores": self.scores,
+            "stray_shots": self.stray_shots,
+            "failures": self.failures,
+        }
+
+
+def find_sessions(session_dir):
+    res = []
+    for (dirpath, dirnames, fnames) in os.walk(session_dir):
+        res.extend(os.path.join(dirpath, fname) for fname in fnames if fname.endswith(replay.SESSION_SUFFIX))
+    return sorted(res)
+
+
+# Shards the sessions over a process pool; sessions are independent, so this scales with the number of cores
+def score_sessions(fnames, processes=None, chunksize=None):
+    processes = processes or os.cpu_count()
+    chunksize = chunksize or max(1, len(fnames) // (processes * 8))
+    report = BatchReport()
+    with multiprocessing.Pool(processes, initializer=init_worker) as pool:
+        for session in pool.imap_unordered(score_session, fnames, chunksize):
+            report.merge(session)
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Re-score a directory of recorded sessions on all cores")
+    parser.add_argument("session_dir")
+    parser.add_argument("--processes", type=int, help="worker processes (default: one per core)")
+    parser.add_argument("--output", help="write the aggregate report as JSON to this file")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    fnames = find_sessions(args.session_dir)
+    start = time.perf_counter()
+    report = score_sessions(fnames, args.processes)
+    seconds = time.perf_counter() - start
+    summary = report.to_json()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    print(f"{summary['sessions']} sessions ({summary['frames']} frames) in {seconds:.2f}s, "
+          f"{len(summary['failures'])} failed")
+    print(f"mean score: {summary['mean_score']:.1f}  hits: {summary['hits']}  stray shots: {summary['misses']}  "
+          f"got through: {summary['got_through']}  not first note: {summary['not_first_note']}")
+    for (note_height_id, stats) in sorted(summary["notes"].items(), key=lambda item: -item[1]["error_rate"]):
+        print(f"{note_height_id:<12}{stats['error_rate']:7.1%}  ({stats['errors']}/{stats['hits'] + stats['errors']})")
@@ -0,0 +1,189 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+from collections import OrderedDict
+
+# Must be set before pygame is imported by main
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame as pg
+
+import headless
+import main
+
+SEED = 1234
+NOTE_COUNTS = [10, 100, 1000, 10000]
+UPDATE_FRAMES = 10
+SCALED_SIZES = [(1920, 1080), (3840, 2160)]
+DEFAULT_BASELINE = os.path.join(main.main_dir, "bench_baseline.json")
+DEFAULT_THRESHOLD = 0.10
+
+
+# Runs fn(setup()) repeats times and returns the median seconds per op, where fn does `ops` operations
+def measure(fn, setup=lambda: None, ops=1, repeats=7):
+    timings = []
+    for _ in range(repeats):
+        state = setup()
+        start = time.perf_counter()
+        fn(state)
+        timings.append((time.perf_counter() - start) / ops)
+    return statistics.median(timings)
+
+
+def new_game(note_count, backend):
+    gamestate = headless.new_headless_game("lesson_4", SEED, backend)
+    rng = random.Random(SEED)
+    headless.add_rain(gamestate, note_count, rng)
+    staff = gamestate.staff
+    ansi_notes = sorted({note_height_id.split("_")[0] for note_height_id in staff.display_heights})
+    for _ in range(note_count):
+        gamestate.send_ansi_note(rng.choice(ansi_notes), rng.random())
+    return gamestate
+
+
+def bench_update(results, backend):
+    for note_count in NOTE_COUNTS:
+        def run(gamestate):
+            for _ in range(UPDATE_FRAMES):
+                gamestate.update()
+        repeats = 3 if note_count >= 10000 else 7
+        results[f"update[{backend},{note_count}]"] = measure(run, lambda: new_game(note_count, backend),
+                                                              ops=UPDATE_FRAMES, repeats=repeats)
+
+
+def bench_note_draw(results, staff, surf):
+    rng = random.Random(SEED)
+    note_height_ids = staff.note_height_ids
+    notes = [main.BasicEnemyNote(rng.uniform(staff.CLEF_PLAY_AREA_POS[0], staff.STAFF_TOP_RIGHT_CORNER[0]),
+                                 rng.choice(note_height_ids), 0, staff.NOTE_X_RADIUS, is_first=False)
+             for _ in range(1000)]
+
+    def draw_notes(_):
+        for note in notes:
+            note.draw(surf, staff)
+
+    def draw_ellipses(_):
+        for note in notes:
+            rect = staff.get_note_rect(note.x_position, staff.display_heights[note.note_height_id])
+            main.draw_ellipse_angle(surf, note.note_color, rect, main.NOTE_ANGLE)
+
+    results["Note.draw"] = measure(draw_notes, ops=len(notes))
+    results["draw_ellipse_angle"] = measure(draw_ellipses, ops=len(notes))
+
+
+def bench_staff(results, staff, surf):
+    results["Staff.render"] = measure(lambda _: staff.render(surf), repeats=20)
+    results["Staff.get_surface"] = measure(lambda _: staff.get_surface(surf.get_size()), repeats=20)
+
+
+# Frame time at the design size on the display, or at another size on an offscreen surface of that size
+def bench_frame(results, renderer_class, size=None):
+    def setup():
+        gamestate = new_game(100, "objects")
+        screen = pg.Surface(size) if size else main.screen
+        screen_staff = main.Staff(main.StaffLayout(screen.get_size()))
+        background = screen_staff.get_surface(screen.get_size())
+        renderer = renderer_class(screen, background, staff=screen_staff)
+        renderer.render(gamestate)
+        return gamestate, renderer
+
+    def run(state):
+        (gamestate, renderer) = state
+        for _ in range(UPDATE_FRAMES):
+            gamestate.update()
+            renderer.render(gamestate)
+
+    name = f"{renderer_class.__name__},{size[0]}x{size[1]}" if size else renderer_class.__name__
+    results[f"frame[{name}]"] = measure(run, setup, ops=UPDATE_FRAMES)
+
+
+def run_benchmarks(only=None):
+    main.init_display()
+    staff = main.Staff()
+    surf = main.new_surface()
+
+    results = OrderedDict()
+    benchmarks = [
+        ("update", lambda: (bench_update(results, "objects"), bench_update(results, "arrays"))),
+        ("draw", lambda: bench_note_draw(results, staff, surf)),
+        ("staff", lambda: bench_staff(results, staff, surf)),
+        ("frame", lambda: (bench_frame(results, main.FullFrameRenderer),
+                           bench_frame(results, main.DirtyRectRenderer),
+                           [bench_frame(results, main.DirtyRectRenderer, size) for size in SCALED_SIZES])),
+    ]
+    for (name, bench) in benchmarks:
+        if not only or name in only:
+            bench()
+    return results
+
+
+def environment():
+    return OrderedDict([
+        ("python", platform.python_version()),
+        ("pygame", pg.version.ver),
+        ("platform", platform.platform()),
+        ("seed", SEED),
+    ])
+
+
+# Prints each result next to the baseline; returns the names that got slower by more than threshold
+def compare(results, baseline, threshold):
+    regressions = []
+    print(f"{'benchmark':<36}{'current':>14}{'baseline':>14}{'change':>10}")
+    for (name, seconds) in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<36}{seconds * 1e6:12.2f}us{'-':>14}{'':>10}")
+            continue
+        change = seconds / base - 1
+        flag = "  REGRESSION" if change > threshold else ""
+        print(f"{name:<36}{seconds * 1e6:12.2f}us{base * 1e6:12.2f}us{change:+9.1%}{flag}")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the simulation and rendering hot paths, headless")
+    parser.add_argument("--only", nargs="*", choices=["update", "draw", "staff", "frame"],
+                        help="benchmark groups to run (default: all)")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="relative slowdown that counts as a regression")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    baseline = {}
+    if not args.save_baseline:
+        if not os.path.exists(args.baseline):
+            # with nothing to compare against every run would pass, e.g. in CI
+            sys.exit(f"no baseline at {args.baseline}; save one with --save-baseline")
+        with open(args.baseline) as f:
+            baseline = json.load(f)["seconds_per_op"]
+    results = run_benchmarks(args.only)
+    report = OrderedDict([("environment", environment()), ("seconds_per_op", results)])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline saved to {args.baseline}")
+    elif regressions:
+        print(f"{len(regressions)} regression(s) over {args.threshold:.0%}")
+        sys.exit(1)
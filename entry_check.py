@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+# Must be set before pygame is imported by main; main.py, run below, inherits them
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import main
+from progress_store import ProgressStore
+
+STUDENT = "entry check"
+FRAMES = 3000
+ACCURACY = 0.5  # low enough that some notes always get through
+
+
+# Plays an autoplayed game through main.py's script entry point with --student, the way students' sessions are
+# saved, and returns what the progress database got: [LessonErrorRate]. A session that tallied side effects against
+# a second copy of main's classes is saved with no hits and no errors.
+def run_student_session(frames=FRAMES, seed=0):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = os.path.join(tmp_dir, "progress.sqlite3")
+        subprocess.run([sys.executable, os.path.join(main.main_dir, "main.py"), "--student", STUDENT,
+                        "--progress-db", db, "--autoplay", str(ACCURACY), "--seed", str(seed),
+                        "--frames", str(frames), "--mute", "--no-log"], check=True)
+        store = ProgressStore(db)
+        lessons = store.lessons_by_error_rate(STUDENT)
+        store.close()
+    return lessons
+
+
+if __name__ == '__main__':
+    lessons = run_student_session()
+    if len(lessons) != 1 or not lessons[0].hits or not lessons[0].errors:
+        sys.exit(f"main.py --student saved {lessons}, expected one session with hits and errors")
+    print(f"ok: {lessons[0].lesson}, {lessons[0].hits} hits, {lessons[0].errors} errors")
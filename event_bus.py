@@ -0,0 +1,93 @@
+import queue
+import sys
+import threading
+
+from collections import defaultdict, deque, namedtuple
+
+TOPIC_SIDE_EFFECT = "side_effect"
+TOPIC_INPUT = "input"
+TOPIC_NOTE_PLAYED = "note_played"
+TOPIC_NOTE_SPAWNED = "note_spawned"
+
+BusEvent = namedtuple("BusEvent", ["seq", "frame", "topic", "payload"])
+
+
+# In-process publish/subscribe for game events. Every event goes into a bounded ring buffer that pull consumers
+# can read with since(); push subscribers are called synchronously on publish, so they must be cheap and must not
+# block (anything doing I/O should hand off to a background thread like AsyncLogWriter does).
+class EventBus:
+    DEFAULT_CAPACITY = 4096
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.ring = deque(maxlen=capacity)
+        self.subscribers = defaultdict(list)
+        self.seq = 0
+
+    # topic None subscribes to every topic
+    def subscribe(self, topic, callback):
+        self.subscribers[topic].append(callback)
+
+    def unsubscribe(self, topic, callback):
+        self.subscribers[topic].remove(callback)
+
+    def publish(self, topic, payload, frame=None):
+        self.seq += 1
+        event = BusEvent(self.seq, frame, topic, payload)
+        self.ring.append(event)
+        for callback in self.subscribers.get(topic, ()):
+            callback(event)
+        for callback in self.subscribers.get(None, ()):
+            callback(event)
+        return event
+
+    # events still in the ring buffer that were published after seq
+    def since(self, seq, topic=None):
+        return [event for event in self.ring if event.seq > seq and (topic is None or event.topic == topic)]
+
+
+def format_event(event):
+    return f"{event.frame}\t{event.topic}\t{event.payload}"
+
+
+# Bus subscriber that writes events to a stream from a background thread, in batches. The frame loop only pays for
+# a queue put; if the writer falls behind by more than max_pending events, new events are dropped and counted.
+class AsyncLogWriter:
+    MAX_PENDING = 8192
+    FLUSH_INTERVAL = 0.25
+
+    def __init__(self, stream=None, max_pending=MAX_PENDING, flush_interval=FLUSH_INTERVAL, formatter=format_event):
+        self.stream = stream or sys.stdout
+        self.pending = queue.Queue(max_pending)
+        self.flush_interval = flush_interval
+        self.formatter = formatter
+        self.dropped = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __call__(self, event):
+        try:
+            self.pending.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while self.running or not self.pending.empty():
+            try:
+                batch = [self.pending.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while True:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            self.stream.write("".join(self.formatter(event) + "\n" for event in batch))
+            self.stream.flush()
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        if self.dropped:
+            self.stream.write(f"{self.dropped} events dropped by the log writer\n")
+            self.stream.flush()
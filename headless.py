@@ -0,0 +1,150 @@
+import argparse
+import os
+import random
+import time
+
+from collections import namedtuple
+
+# Must be set before pygame is imported by main
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import main
+import replay
+
+HeadlessReport = namedtuple("HeadlessReport", ["frames", "seconds", "notes_processed", "score"])
+
+
+# Plays the notes listed in a script file, one "<frame> <ansi note>" pair per line, e.g. "120 C5".
+# Player inputs return the MIDI note numbers to play before the next update.
+class ScriptedInput:
+    def __init__(self, notes_by_frame):
+        self.notes_by_frame = notes_by_frame
+
+    @classmethod
+    def from_file(cls, fname):
+        notes_by_frame = {}
+        with open(fname) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                frame, ansi_note = line.split()
+                notes_by_frame.setdefault(int(frame), []).append(main.ansi_note_to_midi(ansi_note))
+        return cls(notes_by_frame)
+
+    def notes_for_frame(self, gamestate):
+        return self.notes_by_frame.get(gamestate.frame_num + 1, [])
+
+
+# Shoots once at the first enemy note after it has been on screen for reaction_frames, hitting the right pitch with
+# probability accuracy. Good enough to soak-test lessons and the collision rules.
+class AutoPlayer:
+    def __init__(self, accuracy=0.9, reaction_frames=20, rng=None):
+        self.accuracy = accuracy
+        self.reaction_frames = reaction_frames
+        self.rng = rng or random.Random()
+        self.target_id = None
+        self.target_frame = 0
+
+    def notes_for_frame(self, gamestate):
+        if not gamestate.enemy_notes:
+            return []
+        (id, note) = next(iter(gamestate.enemy_notes.items()))
+        if id != self.target_id:
+            self.target_id = id
+            self.target_frame = gamestate.frame_num + self.reaction_frames
+        if gamestate.frame_num != self.target_frame:
+            return []
+        note_height_ids = note.note_height_ids
+        if self.rng.random() > self.accuracy:
+            note_height_ids = [self.rng.choice(gamestate.staff.note_height_ids)]
+        return [main.ansi_note_to_midi(note_height_id.split("_")[0]) for note_height_id in note_height_ids]
+
+
+# Steps GameState.update at the fixed logical timestep as fast as the CPU allows, with no rendering.
+class HeadlessEngine:
+    def __init__(self, gamestate, player_input=None):
+        self.gamestate = gamestate
+        self.player_input = player_input
+
+    def run(self, frames):
+        notes_processed = 0
+        start = time.perf_counter()
+        for _ in range(frames):
+            if self.player_input:
+                for midi_note in self.player_input.notes_for_frame(self.gamestate):
+                    self.gamestate.send_midi_note(midi_note)
+            self.gamestate.update()
+            notes_processed += len(self.gamestate.enemy_notes) + len(self.gamestate.player_notes)
+        seconds = time.perf_counter() - start
+        return HeadlessReport(frames, seconds, notes_processed, self.gamestate.score)
+
+
+def new_headless_game(lesson_name, seed=None, backend="objects", adaptive=False):
+    staff = main.Staff()
+    lesson = main.load_lesson(staff, lesson_name, seed=seed)
+    if backend == "arrays":
+        import note_array
+        gamestate = note_array.ArrayGameState(staff, lesson)
+    else:
+        gamestate = main.GameState(staff, lesson)
+    if adaptive:
+        gamestate.spawn_scheduler = main.AdaptiveSpawnScheduler(gamestate)
+    return gamestate
+
+
+# Scatter count enemy notes over the play area, for stress runs
+def add_rain(gamestate, count, rng):
+    staff = gamestate.staff
+    note_height_ids = staff.note_height_ids
+    x_positions = [rng.uniform(staff.CLEF_PLAY_AREA_POS[0], staff.STAFF_TOP_RIGHT_CORNER[0]) for _ in range(count)]
+    heights = [rng.choice(note_height_ids) for _ in range(count)]
+    speed = main.BasicEnemyNote.ENEMY_NOTE_SPEED
+    if hasattr(gamestate, "register_enemy_notes"):
+        gamestate.register_enemy_notes(x_positions, heights, speed, staff.CLEF_PLAY_AREA_POS[0])
+        return
+    for (x_position, note_height_id) in zip(x_positions, heights):
+        gamestate.register_enemy_note(main.BasicEnemyNote(x_position, note_height_id, staff.CLEF_PLAY_AREA_POS[0],
+                                                          staff.NOTE_X_RADIUS, is_first=False))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the game simulation without a display or MIDI device")
+    parser.add_argument("--lesson", default="lesson_4", help="lesson name or number, or a song file (.song, .mid)")
+    parser.add_argument("--frames", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--script", help="file of '<frame> <ansi note>' lines to play")
+    parser.add_argument("--backend", choices=["objects", "arrays"], default="objects",
+                        help="note storage: one Python object per note, or NumPy arrays (note_array.py)")
+    parser.add_argument("--rain", type=int, default=0, help="number of extra enemy notes to start with")
+    parser.add_argument("--accuracy", type=float, default=0.9, help="autoplayer accuracy when no script is given")
+    parser.add_argument("--adaptive", action="store_true", help="use the adaptive spawn scheduler")
+    parser.add_argument("--record", metavar="FILE", help="record the session for replay.py")
+    args = parser.parse_args()
+    # session logs store neither, so the replay would be a different game
+    if args.record and (args.rain or args.backend != "objects"):
+        parser.error("--record can't be combined with --rain or --backend arrays")
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    gamestate = new_headless_game(args.lesson, args.seed, args.backend, args.adaptive)
+    if args.rain:
+        add_rain(gamestate, args.rain, random.Random(args.seed))
+    if args.script:
+        player_input = ScriptedInput.from_file(args.script)
+    else:
+        player_input = AutoPlayer(args.accuracy, rng=random.Random(args.seed))
+
+    if args.record:
+        gamestate.input_recorder = replay.SessionRecorder(args.record, gamestate.lesson.seed, gamestate.lesson.name,
+                                                          args.adaptive)
+
+    report = HeadlessEngine(gamestate, player_input).run(args.frames)
+    if args.record:
+        gamestate.input_recorder.close(gamestate.frame_num)
+    print(f"frames: {report.frames} in {report.seconds:.3f}s ({report.frames / report.seconds:.0f} frames/sec)")
+    print(f"notes processed: {report.notes_processed} ({report.notes_processed / report.seconds:.0f} notes/sec)")
+    print(f"score: {report.score}")
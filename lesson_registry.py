@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+
+from array import array
+from collections import namedtuple
+
+LESSON_SUFFIX = ".txt"
+CACHE_DIR_NAME = "__lessoncache__"
+CACHE_FORMAT_VERSION = 3
+CHORD_SEPARATOR = "+"
+
+
+class LessonError(ValueError):
+    pass
+
+
+# notes is a compact table of indices into note_height_ids, the staff's ordered list of note height ids. A lesson
+# entry is a single note or a chord ("C4_TREBLE+E4_TREBLE+G4_TREBLE"); sizes holds how many notes each entry
+# takes up in notes. note_height_ids run down the staff from its highest note, so a chord's notes are stored by
+# descending index: low to high, the way chords are written.
+CompiledLesson = namedtuple("CompiledLesson", ["name", "notes", "sizes", "note_height_ids"])
+
+
+def compile_lesson(name, fname, note_height_ids):
+    height_index = {note_height_id: i for (i, note_height_id) in enumerate(note_height_ids)}
+    notes = array('B')
+    sizes = array('B')
+    with open(fname) as f:
+        for (line_no, line) in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            heights = set()
+            for note_height_id in line.split(CHORD_SEPARATOR):
+                if note_height_id not in height_index:
+                    raise LessonError(f"{fname}:{line_no}: unknown note '{note_height_id}'")
+                heights.add(height_index[note_height_id])
+            notes.extend(sorted(heights, reverse=True))
+            sizes.append(len(heights))
+    if not sizes:
+        raise LessonError(f"{fname}: lesson has no notes")
+    return CompiledLesson(name, notes, sizes, tuple(note_height_ids))
+
+
+# the lesson's entries as tuples of indices into note_height_ids, one index for a single note
+def lesson_entries(lesson):
+    pos = 0
+    for size in lesson.sizes:
+        yield tuple(lesson.notes[pos:pos + size])
+        pos += size
+
+
+# Scans a lessons directory once and compiles lessons on first use. Compiled tables are cached on disk next to
+# the lessons, keyed by the source file's mtime and size and by the staff's note height ids, so a lesson is only
+# parsed again when it (or the staff layout) changes. Malformed lessons raise LessonError when they are loaded.
+class LessonRegistry:
+    def __init__(self, note_height_ids, lessons_dir, cache_dir=None):
+        self.note_height_ids = tuple(note_height_ids)
+        self.heights_key = hashlib.sha1("\n".join(self.note_height_ids).encode()).hexdigest()
+        self.lessons_dir = lessons_dir
+        self.cache_dir = cache_dir or os.path.join(lessons_dir, CACHE_DIR_NAME)
+        self.paths = {}
+        self.compiled = {}
+        with os.scandir(lessons_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(LESSON_SUFFIX):
+                    self.paths[entry.name[:-len(LESSON_SUFFIX)]] = entry.path
+
+    def names(self):
+        return sorted(self.paths)
+
+    def __contains__(self, name):
+        return name in self.paths
+
+    def get(self, name):
+        lesson = self.compiled.get(name)
+        if lesson is None:
+            if name not in self.paths:
+                raise LessonError(f"no lesson named '{name}' in {self.lessons_dir}")
+            lesson = self.compiled[name] = self.load(name)
+        return lesson
+
+    def load(self, name):
+        fname = self.paths[name]
+        stat = os.stat(fname)
+        cache_key = {"version": CACHE_FORMAT_VERSION, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size,
+                     "heights": self.heights_key}
+        cache_fname = os.path.join(self.cache_dir, name + ".json")
+
+        cached = self.read_cache(cache_fname)
+        if cached and cached["key"] == cache_key:
+            return CompiledLesson(name, array('B', cached["notes"]), array('B', cached["sizes"]), self.note_height_ids)
+
+        lesson = compile_lesson(name, fname, self.note_height_ids)
+        self.write_cache(cache_fname, {"key": cache_key, "notes": lesson.notes.tolist(),
+                                       "sizes": lesson.sizes.tolist()})
+        return lesson
+
+    def read_cache(self, cache_fname):
+        try:
+            with open(cache_fname) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_cache(self, cache_fname, contents):
+        # the cache is an optimisation only, e.g. the lessons directory may be read-only
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_fname = cache_fname + ".tmp"
+            with open(tmp_fname, "w") as f:
+                json.dump(contents, f)
+            os.replace(tmp_fname, cache_fname)
+        except OSError:
+            pass
@@ -1,9 +1,14 @@
 import abc
+import argparse
+import bisect
 import copy
 import math
+import queue
 import random
+import threading
+import time
 
-from collections import OrderedDict
+from collections import Counter, OrderedDict, deque, namedtuple
 
 import pygame as pg
 import pygame.midi
@@ -13,23 +18,49 @@ import os
 
 from pygame.locals import *
 
+from asset_cache import AssetCache
+from event_bus import AsyncLogWriter, EventBus, TOPIC_INPUT, TOPIC_NOTE_PLAYED, TOPIC_NOTE_SPAWNED, TOPIC_SIDE_EFFECT
+from lesson_registry import CHORD_SEPARATOR, LessonRegistry, lesson_entries
+from profiler import FrameProfiler, NULL_PROFILER
+from song import SONG_SUFFIXES, ansi_note_to_midi, read_song
+
 FPS = 30
-pg.init()
+FRAME_MS = 1000 / FPS
+MAX_FRAMES_PER_TICK = 5  # don't spiral when rendering falls behind, just drop simulation time
 fpsClock = pg.time.Clock()
 
 SCREEN_WIDTH, SCREEN_HEIGHT = 720, 640
-screen = pg.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), 0, 32)
-clock = pg.time.Clock()
+screen = None
 
 LINE_WEIGHT_BOLD = 8
 LINE_WEIGHT_STANDARD = 2
 LINE_WEIGHT_LIGHT = 1
 
+NOTE_ANGLE = 20
+PLAYER_NOTE_COLOR = (0, 125, 0, 255)
+ENEMY_NOTE_COLOR = (128, 0, 255, 255)
+FIRST_ENEMY_NOTE_COLOR = (255, 0, 0, 255)
+NOTE_COLORS = [PLAYER_NOTE_COLOR, ENEMY_NOTE_COLOR, FIRST_ENEMY_NOTE_COLOR]
+
+MIDI_KEY_DOWN = 144
+MIDI_MAX_VELOCITY = 127
+MIDI_NOTES = 128
+FRAME_OFFSET_STEPS = 255  # sub-frame shot offsets are quantised to this many steps so recordings replay exactly
+CHORD_WINDOW_MS = 40  # in chord lessons, note-ons closer together than this are played as one chord
+
 main_dir = os.path.split(os.path.abspath(__file__))[0]
 
 
-def get_asset_file(file):
-    return os.path.join(main_dir, "assets", file)
+# The display is opened explicitly rather than at import, so the simulation can be driven headless
+# (see headless.py) without a window or a MIDI device.
+def init_display(size=(SCREEN_WIDTH, SCREEN_HEIGHT), flags=0):
+    global screen
+    pg.init()
+    screen = pg.display.set_mode(size, flags, 32)
+    return screen
+
+
+assets = AssetCache(os.path.join(main_dir, "assets"))
 
 
 def draw_line_horizontal(surf, color, pos, width, line_weight=LINE_WEIGHT_STANDARD):
@@ -42,6 +73,37 @@ def draw_line_vertical(surf, color, pos, height, line_weight=LINE_WEIGHT_STANDAR
     pg.draw.rect(surf, color, r)
 
 
+# Staff geometry for a window size. The staff is designed at SCREEN_WIDTH x SCREEN_HEIGHT; other sizes scale it
+# uniformly, centered to keep its aspect ratio, with every length rounded to whole pixels so lines stay crisp.
+# The simulation always runs in design coordinates, whatever the window size; screen_x() maps a note's
+# x_position onto the window.
+class StaffLayout:
+    def __init__(self, size=(SCREEN_WIDTH, SCREEN_HEIGHT)):
+        self.size = tuple(size)
+        self.scale = min(self.size[0] / SCREEN_WIDTH, self.size[1] / SCREEN_HEIGHT)
+        self.offset = (round((self.size[0] - SCREEN_WIDTH * self.scale) / 2),
+                       round((self.size[1] - SCREEN_HEIGHT * self.scale) / 2))
+
+    def length(self, length):
+        return round(length * self.scale)
+
+    # line weights never round down to nothing
+    def weight(self, weight):
+        return max(1, round(weight * self.scale))
+
+    def point(self, pos):
+        return [self.offset[0] + round(pos[0] * self.scale), self.offset[1] + round(pos[1] * self.scale)]
+
+    def screen_x(self, x_position):
+        return self.offset[0] + x_position * self.scale
+
+
+CLEFS = ["TREBLE", "BASS"]
+
+# Where a MIDI note goes on the staff; height is the index of note_height_id in Staff.note_height_ids
+PitchEntry = namedtuple("PitchEntry", ["clef", "note_height_id", "height", "y", "ledger_lines"])
+
+
 class Staff(object):
     STAFF_POS = [15, 15]
     STAFF_WIDTH = 680
@@ -55,6 +117,9 @@ class Staff(object):
     HEADROOM_LEFT = 20
     HEADROOM_RIGHT = 20
     STAFF_LINE_WEIGHT = LINE_WEIGHT_STANDARD
+    BAR_LINE_WEIGHT = LINE_WEIGHT_BOLD
+    PLAY_AREA_LINE_WEIGHT = LINE_WEIGHT_STANDARD
+    OUTER_BOUND_LINE_WEIGHT = LINE_WEIGHT_LIGHT
 
     NOTE_SPACE_WIDTH = 18
     NOTE_Y_RADIUS = math.floor((NOTE_SPACE_WIDTH + STAFF_LINE_WEIGHT) / 2)
@@ -79,7 +144,11 @@ class Staff(object):
     CLEF_PLAY_AREA_OFFSET = 150  # TODO function of key signature
     CLEF_PLAY_AREA_POS = [STAFF_POS[0] + CLEF_PLAY_AREA_OFFSET, STAFF_POS[1]]
 
-    def __init__(self):
+    # The class constants above are the design at SCREEN_WIDTH x SCREEN_HEIGHT; an instance scales them to its layout
+    def __init__(self, layout=None):
+        self.layout = layout or StaffLayout()
+        self.apply_layout(self.layout)
+
         self.STAFF_TOP_RIGHT_CORNER = copy.deepcopy(self.STAFF_POS)
         self.STAFF_TOP_RIGHT_CORNER[0] = self.STAFF_TOP_RIGHT_CORNER[0] + self.STAFF_WIDTH
         self.STAFF_BOTTOM_LEFT_CORNER = copy.deepcopy(self.STAFF_POS)
@@ -90,7 +159,54 @@ class Staff(object):
         self.bass_line_heights = self.get_clef_line_heights(self.BASS_CLEF_POS)
         self.bass_space_heights = self.get_clef_space_heights(self.bass_line_heights)
         self.display_heights = self.get_display_heights()
+        self.note_height_ids = list(self.display_heights)
         self.extra_line_heights = self.get_extra_line_heights()
+        self.pitch_tables = {clef: self.get_pitch_table(clef) for clef in CLEFS}
+        self.midi_notes = {note_height_id: ansi_note_to_midi(note_height_id.split("_")[0])
+                           for note_height_id in self.note_height_ids}
+        self.note_sprites = NoteSpriteCache(self)
+        self.note_sprites.prerender(NOTE_COLORS)
+
+    def apply_layout(self, layout):
+        design = type(self)
+        self.STAFF_POS = layout.point(design.STAFF_POS)
+        self.STAFF_WIDTH = layout.length(design.STAFF_WIDTH)
+        self.STAFF_HEIGHT = layout.length(design.STAFF_HEIGHT)
+
+        self.HEADROOM_TOP = layout.length(design.HEADROOM_TOP)
+        self.HEADROOM_BOTTOM = layout.length(design.HEADROOM_BOTTOM)
+        self.INTER_STAFF_HEAD_ROOM = layout.length(design.INTER_STAFF_HEAD_ROOM)
+
+        self.HEADROOM_LEFT = layout.length(design.HEADROOM_LEFT)
+        self.HEADROOM_RIGHT = layout.length(design.HEADROOM_RIGHT)
+        self.STAFF_LINE_WEIGHT = layout.weight(design.STAFF_LINE_WEIGHT)
+        self.BAR_LINE_WEIGHT = layout.weight(design.BAR_LINE_WEIGHT)
+        self.PLAY_AREA_LINE_WEIGHT = layout.weight(design.PLAY_AREA_LINE_WEIGHT)
+        self.OUTER_BOUND_LINE_WEIGHT = layout.weight(design.OUTER_BOUND_LINE_WEIGHT)
+
+        self.NOTE_SPACE_WIDTH = layout.length(design.NOTE_SPACE_WIDTH)
+        self.NOTE_Y_RADIUS = math.floor((self.NOTE_SPACE_WIDTH + self.STAFF_LINE_WEIGHT) / 2)
+        self.NOTE_OBLONGNESS = layout.length(design.NOTE_OBLONGNESS)
+        self.NOTE_X_RADIUS = self.NOTE_Y_RADIUS + self.NOTE_OBLONGNESS
+
+        self.INDIVIDUAL_CLEF_HEIGHT = 5 * self.STAFF_LINE_WEIGHT + 4 * self.NOTE_SPACE_WIDTH
+        self.INDIVIDUAL_CLEF_WIDTH = self.STAFF_WIDTH - (self.HEADROOM_LEFT + self.HEADROOM_RIGHT)
+
+        self.TREBLE_CLEF_POS = [self.STAFF_POS[0] + self.HEADROOM_LEFT, self.STAFF_POS[1] + self.HEADROOM_TOP]
+        self.BASS_CLEF_POS = [self.STAFF_POS[0] + self.HEADROOM_LEFT, self.STAFF_POS[1] + self.HEADROOM_TOP +
+                              self.INDIVIDUAL_CLEF_HEIGHT + self.INTER_STAFF_HEAD_ROOM]
+
+        self.TREBLE_IMAGE_SCALE = design.TREBLE_IMAGE_SCALE * layout.scale
+        self.TREBLE_IMAGE_HEADROOM_LEFT = layout.length(design.TREBLE_IMAGE_HEADROOM_LEFT)
+        self.BASS_IMAGE_SCALE = design.BASS_IMAGE_SCALE * layout.scale
+        self.BASS_IMAGE_HEADROOM_LEFT = layout.length(design.BASS_IMAGE_HEADROOM_LEFT)
+
+        self.CLEF_PLAY_AREA_OFFSET = layout.length(design.CLEF_PLAY_AREA_OFFSET)
+        self.CLEF_PLAY_AREA_POS = [self.STAFF_POS[0] + self.CLEF_PLAY_AREA_OFFSET, self.STAFF_POS[1]]
+
+        # note x_positions are in design coordinates, see StaffLayout
+        self.x_offset = layout.offset[0]
+        self.x_scale = layout.scale
 
     def get_clef_space_heights(self, line_heights):
         res = []
@@ -101,8 +217,7 @@ class Staff(object):
     # image offset_anchor is what percent of the way down the image is the anchor note height
     # e.g., the treble clef wants the curly bit to be in G4 and the bass clef wants F3 between the dots theah
     def draw_clef_symbol(self, image_file, image_scale, image_offset_anchor, image_headroom_left, note_height, surf):
-        treble_image = pg.transform.rotozoom(pg.image.load(get_asset_file(image_file)).convert_alpha(), 0,
-                                             image_scale)
+        treble_image = assets.scaled(image_file, image_scale)
         clef_symbol_y = note_height - math.floor(treble_image.get_height() * image_offset_anchor)
         surf.blit(treble_image, [self.STAFF_POS[0] + image_headroom_left, clef_symbol_y])
 
@@ -114,20 +229,33 @@ class Staff(object):
         return res
 
     def draw_clef_lines(self, clef_pos, line_heights, surf):
-        draw_line_vertical(surf, self.COLOR, clef_pos, self.INDIVIDUAL_CLEF_HEIGHT, LINE_WEIGHT_BOLD)
+        draw_line_vertical(surf, self.COLOR, clef_pos, self.INDIVIDUAL_CLEF_HEIGHT, self.BAR_LINE_WEIGHT)
         draw_line_vertical(surf, self.COLOR, [clef_pos[0] + self.INDIVIDUAL_CLEF_WIDTH, clef_pos[1]],
-                           self.INDIVIDUAL_CLEF_HEIGHT, LINE_WEIGHT_BOLD)
+                           self.INDIVIDUAL_CLEF_HEIGHT, self.BAR_LINE_WEIGHT)
         draw_line_vertical(surf, self.COLOR, [clef_pos[0] + self.CLEF_PLAY_AREA_OFFSET, clef_pos[1]],
-                           self.INDIVIDUAL_CLEF_HEIGHT, LINE_WEIGHT_STANDARD)
+                           self.INDIVIDUAL_CLEF_HEIGHT, self.PLAY_AREA_LINE_WEIGHT)
 
         for line_height in line_heights:
             line_pos = [clef_pos[0], line_height]
             draw_line_horizontal(surf, self.COLOR, line_pos, self.INDIVIDUAL_CLEF_WIDTH, self.STAFF_LINE_WEIGHT)
         return line_heights
 
-    def draw(self, surf):
+    CLEF_IMAGE_FILES = ["treble_clef.png", "bass_clef.png"]
+
+    # everything that render() depends on, so a composed staff can be shared between equal staves
+    def layout_key(self):
+        return (type(self).__name__, tuple(self.STAFF_POS), self.STAFF_WIDTH, self.STAFF_HEIGHT,
+                tuple(self.TREBLE_CLEF_POS), tuple(self.BASS_CLEF_POS), self.NOTE_SPACE_WIDTH,
+                self.STAFF_LINE_WEIGHT, self.BAR_LINE_WEIGHT, self.TREBLE_IMAGE_SCALE, self.BASS_IMAGE_SCALE)
+
+    # The staff is composed once per layout and surface size: get_surface() hands back an opaque surface with the
+    # staff drawn over background, ready to use as the screen background
+    def get_surface(self, size, background=(255, 255, 255)):
+        return assets.compose(self.layout_key(), size, self.CLEF_IMAGE_FILES, self.render, background)
+
+    def render(self, surf):
         # outer bounding rectangle
-        outer_bound_lw = LINE_WEIGHT_LIGHT
+        outer_bound_lw = self.OUTER_BOUND_LINE_WEIGHT
         draw_line_vertical(surf, self.COLOR, self.STAFF_POS, self.STAFF_HEIGHT, outer_bound_lw)
         draw_line_vertical(surf, self.COLOR, self.STAFF_TOP_RIGHT_CORNER, self.STAFF_HEIGHT, outer_bound_lw)
         draw_line_horizontal(surf, self.COLOR, self.STAFF_POS, self.STAFF_WIDTH, outer_bound_lw)
@@ -199,6 +327,18 @@ class Staff(object):
         }
         return heights
 
+    # 128-entry table indexed by MIDI note number. Notes that fit on both clefs (C4, B3, ...) go to preferred_clef,
+    # notes with no staff position (accidentals, out of range) are None.
+    def get_pitch_table(self, preferred_clef):
+        table = [None] * MIDI_NOTES
+        for (height, note_height_id) in enumerate(self.note_height_ids):
+            (ansi_note, clef) = note_height_id.split("_")
+            midi_note = ansi_note_to_midi(ansi_note)
+            if table[midi_note] is None or clef == preferred_clef:
+                table[midi_note] = PitchEntry(clef, note_height_id, height, self.display_heights[note_height_id],
+                                              self.extra_line_heights.get(note_height_id, []))
+        return table
+
     def get_extra_line_heights(self):
 
         prototype = {
@@ -229,6 +369,92 @@ class Staff(object):
         return res
 
 
+# Note heads (and their ledger lines) are rendered once per (color, note height, scale, angle) instead of
+# allocating and rotating a fresh surface for every note on every frame. get() hands back the sprite together
+# with the offset of its top-left corner from the note's center, so drawing a note is a single blit.
+class NoteSpriteCache:
+    LEDGER_LINE_WEIGHT = 1.5  # relative to the staff lines
+
+    def __init__(self, staff):
+        self.staff = staff
+        self.sprites = {}
+        self.ledger_line_weight = self.LEDGER_LINE_WEIGHT * staff.STAFF_LINE_WEIGHT
+
+    def prerender(self, colors, scale=1, angle=NOTE_ANGLE):
+        for color in colors:
+            for note_height_id in self.staff.display_heights:
+                self.get(color, note_height_id, scale, angle)
+
+    def get(self, color, note_height_id, scale=1, angle=NOTE_ANGLE):
+        key = (color, note_height_id, scale, angle)
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            sprite = self.render(color, note_height_id, scale, angle)
+            self.sprites[key] = sprite
+        return sprite
+
+    def render(self, color, note_height_id, scale, angle):
+        head_rect = self.staff.get_note_rect(0, 0, scale)
+        head = pg.Surface(head_rect.size, pg.SRCALPHA)
+        pg.draw.ellipse(head, color, (0, 0, head_rect.width, head_rect.height))
+        head = pg.transform.rotate(head, angle)
+        head_pos = head.get_rect(center=head_rect.center).topleft
+
+        # ledger lines, relative to the note center
+        note_height = self.staff.display_heights[note_height_id]
+        ledger_rects = []
+        for line_height in self.staff.extra_line_heights.get(note_height_id, []):
+            ledger_rects.append(pg.Rect(math.floor(-self.staff.NOTE_X_RADIUS * 1.5 * scale),
+                                        math.floor(line_height - note_height - self.ledger_line_weight / 2),
+                                        math.ceil(self.staff.NOTE_X_RADIUS * 3.25 * scale),
+                                        self.ledger_line_weight))
+
+        bounds = head.get_rect(topleft=head_pos).unionall(ledger_rects) if ledger_rects \
+            else head.get_rect(topleft=head_pos)
+        sprite = pg.Surface(bounds.size, pg.SRCALPHA)
+        sprite.blit(head, (head_pos[0] - bounds.left, head_pos[1] - bounds.top))
+        for r in ledger_rects:
+            pg.draw.rect(sprite, color, r.move(-bounds.left, -bounds.top))
+        return sprite, bounds.topleft
+
+
+fonts = {}
+
+
+# SysFont does a system font lookup every call, so fonts are resolved once per (name, size)
+def get_font(font_name, size):
+    font = fonts.get((font_name, size))
+    if font is None:
+        font = fonts[(font_name, size)] = pg.font.SysFont(font_name, size)
+    return font
+
+
+# Renders text in one font, keeping the most recently used surfaces so that text which doesn't change between
+# frames (score, streak, lesson name, ...) is only rendered once
+class TextRenderer:
+    MAX_CACHED_SURFACES = 64
+
+    def __init__(self, font_name, size, antialias=True):
+        self.font_name = font_name
+        self.size = size
+        self.antialias = antialias
+        self.surfaces = OrderedDict()
+
+    def render(self, text, color):
+        key = (text, color)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = get_font(self.font_name, self.size).render(text, self.antialias, color)
+            self.surfaces[key] = surface
+            if len(self.surfaces) > self.MAX_CACHED_SURFACES:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(key)
+        return surface
+
+    def draw(self, surf, text, color, pos):
+        return surf.blit(self.render(text, color), pos)
+
 
 from enum import Enum
 
@@ -242,20 +468,340 @@ class NoteCollisionSideEffect(Enum):
     COLLISION_NOT_FIRST_NOTE = 5
 
 
+# Side effects that count against the note height they happened on: the enemy note's, so a wrong key is charged to
+# the note that should have been played. PLAYER_MISSED_ALL is on the stray pitch that was played instead, which the
+# lesson may never even spawn, and the enemy it missed already counts once when it gets through.
+ERROR_SIDE_EFFECTS = {
+    NoteCollisionSideEffect.ENEMY_NOTE_GOT_THROUGH,
+    NoteCollisionSideEffect.COLLISION_NOT_FIRST_NOTE,
+}
+
+
+# Enemy notes bucketed by note_height_id and sorted by x_position within a bucket, so a shot is only tested against
+# enemies on its own pitch line. Matches the nested player x enemy loop exactly: a shot collides with the earliest
+# registered enemy that is on its line, hasn't got a side effect yet and is to the left of it.
+class NoteCollisionIndex:
+    def __init__(self):
+        self.buckets = {}
+        self.bucket_xs = {}
+
+    def rebuild(self, enemy_notes):
+        self.buckets.clear()
+        self.bucket_xs.clear()
+        for (id, note) in enemy_notes.items():
+            bucket = self.buckets.get(note.note_height_id)
+            if bucket is None:
+                bucket = self.buckets[note.note_height_id] = []
+            bucket.append((note.x_position, id, note))
+        for (note_height_id, bucket) in self.buckets.items():
+            bucket.sort(key=lambda entry: (entry[0], entry[1]))  # already ~sorted, notes move in lockstep
+            self.bucket_xs[note_height_id] = [entry[0] for entry in bucket]
+
+    def try_interact(self, player_note):
+        if player_note.side_effect is not None:
+            return
+        bucket = self.buckets.get(player_note.note_height_id)
+        if not bucket:
+            return
+        end = bisect.bisect_left(self.bucket_xs[player_note.note_height_id], player_note.x_position)
+        target = None
+        for (x_position, id, enemy_note) in bucket[:end]:
+            if not enemy_note.side_effect and (target is None or id < target[0]):
+                target = (id, enemy_note)
+        if target:
+            target[1].try_interact(player_note)
+
+
+# Recycles destroyed notes so that spawning and shooting don't allocate. Notes are reset in place, either from
+# constructor arguments (acquire) or by copying the slots of a prototype note (acquire_copy).
+class NotePool:
+    def __init__(self):
+        self.free = {}
+        self.slot_names = {}
+
+    # every slot of note_class, including those declared by its base classes
+    def get_slot_names(self, note_class):
+        names = self.slot_names.get(note_class)
+        if names is None:
+            names = self.slot_names[note_class] = \
+                [name for cls in note_class.__mro__ for name in cls.__dict__.get("__slots__", ())]
+        return names
+
+    def acquire(self, note_class, *args, **kwargs):
+        free = self.free.get(note_class)
+        if not free:
+            return note_class(*args, **kwargs)
+        note = free.pop()
+        note.reset(*args, **kwargs)
+        return note
+
+    def acquire_copy(self, prototype):
+        note_class = type(prototype)
+        free = self.free.get(note_class)
+        note = free.pop() if free else note_class.__new__(note_class)
+        for name in self.get_slot_names(note_class):
+            setattr(note, name, getattr(prototype, name))
+        return note
+
+    def release(self, note):
+        free = self.free.get(type(note))
+        if free is None:
+            free = self.free[type(note)] = []
+        free.append(note)
+
+
+# Each lesson has its own seeded RNG so a session can be replayed exactly from its seed and inputs
+SideEffect = namedtuple("SideEffect", ["side_effect", "note_height_id"])
+NotePlayed = namedtuple("NotePlayed", ["midi_note", "velocity"])
+
+
+# the clef most of the notes are on
+def lesson_clef(note_height_ids):
+    counts = Counter(note_height_id.split("_")[1] for note_height_id in note_height_ids)
+    return counts.most_common(1)[0][0] if counts else CLEFS[0]
+
+
 class RandomLesson:
-    def __init__(self, available_notes, key_signature):
+    def __init__(self, available_notes, key_signature, seed=None, name=None):
         self.available_notes = available_notes
         self.key_signature = key_signature
         self.size = len(available_notes)
+        self.name = name
+        # session logs store the seed as a u64
+        self.seed = (random.randrange(2 ** 32) if seed is None else seed) & (2 ** 64 - 1)
+        self.rng = random.Random(self.seed)
+        self.clef = lesson_clef(note_height_id for note in available_notes for note_height_id in note.note_height_ids)
+        self.has_chords = any(len(note.note_height_ids) > 1 for note in available_notes)
+
+    def new_note(self, pool=None):
+        return self.note_at(self.rng.randint(0, self.size - 1), pool)
+
+    def note_at(self, index, pool=None):
+        prototype = self.available_notes[index]
+        if pool is None:
+            return copy.deepcopy(prototype)
+        return pool.acquire_copy(prototype)
+
+    def new_spawn_scheduler(self, staff):
+        return FixedSpawnScheduler()
+
+
+# Spawn schedulers return the notes to spawn on the current frame, usually none or one. This one spawns a note every
+# SPAWN_SPEED frames, picked uniformly by the lesson; it is the default for random lessons.
+class FixedSpawnScheduler:
+    def spawn(self, gamestate):
+        if gamestate.frame_num % gamestate.SPAWN_SPEED == 0:
+            return (gamestate.lesson.new_note(gamestate.note_pool),)
+        return ()
+
+
+# Vose's alias method: after O(n) setup, sample_alias_table picks index i with probability weights[i] / sum(weights)
+# from one random index and one biased coin flip
+AliasTable = namedtuple("AliasTable", ["prob", "alias"])
+
+
+def build_alias_table(weights):
+    n = len(weights)
+    total = sum(weights)
+    scaled = [weight * n / total for weight in weights]
+    prob = [1.0] * n
+    alias = list(range(n))
+    small = [i for (i, p) in enumerate(scaled) if p < 1]
+    large = [i for (i, p) in enumerate(scaled) if p >= 1]
+    while small and large:
+        (less, more) = (small.pop(), large.pop())
+        prob[less] = scaled[less]
+        alias[less] = more
+        scaled[more] -= 1 - scaled[less]
+        (small if scaled[more] < 1 else large).append(more)
+    return AliasTable(prob, alias)
+
+
+def sample_alias_table(table, rng):
+    i = rng.randrange(len(table.prob))
+    return i if rng.random() < table.prob[i] else table.alias[i]
+
+
+# How a student is doing on one lesson entry (note or chord): moving averages of the miss rate and of the hit
+# latency in frames from spawn to hit. spawn_frames are the spawn frames of the entry's notes still on the staff;
+# notes of one pitch leave the staff in the order they spawned, so the oldest is the one that was hit.
+class NoteStats:
+    __slots__ = ("hits", "misses", "miss_rate", "latency", "spawn_frames")
 
-    def new_note(self):
-        return copy.deepcopy(self.available_notes[random.randint(0, self.size - 1)])
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.miss_rate = 0.0
+        self.latency = None
+        self.spawn_frames = deque()
+
+    def record(self, missed, latency, smoothing):
+        if missed:
+            self.misses += 1
+        else:
+            self.hits += 1
+        self.miss_rate += smoothing * (missed - self.miss_rate)
+        if latency is not None:
+            self.latency = latency if self.latency is None else self.latency + smoothing * (latency - self.latency)
+
+
+# Spawns the notes a student misses or is slow on more often, and changes the spawn interval to keep their miss rate
+# around TARGET_MISS_RATE, backing off further while they're in pain. Stats are fed from the side effect bus in O(1)
+# per event. The alias table notes are sampled from is precomputed: it is only rebuilt, on the next spawn, once
+# REBUILD_OUTCOMES notes have been hit or missed since the last build, so most spawns are one O(1) sample and the
+# weights lag the stats by at most that many outcomes. Sampling uses the lesson's RNG, so sessions still replay
+# exactly.
+class AdaptiveSpawnScheduler:
+    STATS_SMOOTHING = 0.2  # weight of the newest outcome in the moving averages
+    MISS_WEIGHT = 4
+    LATENCY_WEIGHT = 2
+    TARGET_MISS_RATE = 0.2
+    SPAWN_INTERVAL_STEP = 2
+    MIN_SPAWN_INTERVAL = 10
+    MAX_SPAWN_INTERVAL = 50
+    REBUILD_OUTCOMES = 8
+
+    # side effects that end an enemy note, and whether they count as a miss
+    OUTCOMES = {
+        NoteCollisionSideEffect.SUCCESSFUL_COLLISION_ENEMY: False,
+        NoteCollisionSideEffect.ENEMY_NOTE_GOT_THROUGH: True,
+        NoteCollisionSideEffect.COLLISION_NOT_FIRST_NOTE: True,
+    }
+
+    def __init__(self, gamestate):
+        if not isinstance(gamestate.lesson, RandomLesson):
+            raise ValueError("adaptive spawning needs a lesson of random notes, not a song")
+        self.lesson = gamestate.lesson
+        self.keys = [note.note_height_id for note in self.lesson.available_notes]
+        self.stats = {key: NoteStats() for key in self.keys}
+        self.spawn_interval = gamestate.SPAWN_SPEED
+        self.next_spawn_frame = gamestate.SPAWN_SPEED
+        self.alias_table = None
+        self.outcomes_since_build = 0
+        gamestate.bus.subscribe(TOPIC_SIDE_EFFECT, self.record_side_effect)
+
+    def record_side_effect(self, event):
+        missed = self.OUTCOMES.get(event.payload.side_effect)
+        stats = self.stats.get(event.payload.note_height_id)
+        if missed is None or stats is None:
+            return
+        spawn_frame = stats.spawn_frames.popleft() if stats.spawn_frames else None
+        latency = event.frame - spawn_frame if spawn_frame is not None and not missed else None
+        stats.record(missed, latency, self.STATS_SMOOTHING)
+        self.outcomes_since_build += 1
+        if self.outcomes_since_build >= self.REBUILD_OUTCOMES:
+            self.alias_table = None
+
+        # drifts to where the miss rate is TARGET_MISS_RATE
+        step = 1 - self.TARGET_MISS_RATE if missed else -self.TARGET_MISS_RATE
+        self.spawn_interval = min(max(self.spawn_interval + self.SPAWN_INTERVAL_STEP * step, self.MIN_SPAWN_INTERVAL),
+                                  self.MAX_SPAWN_INTERVAL)
+
+    def weights(self):
+        latencies = [stats.latency for stats in self.stats.values() if stats.latency is not None]
+        mean_latency = sum(latencies) / len(latencies) if latencies else None
+        res = []
+        for key in self.keys:
+            stats = self.stats[key]
+            weight = 1 + self.MISS_WEIGHT * stats.miss_rate
+            if mean_latency and stats.latency is not None:
+                weight += self.LATENCY_WEIGHT * max(stats.latency / mean_latency - 1, 0.0)
+            res.append(weight)
+        return res
+
+    def spawn(self, gamestate):
+        if gamestate.frame_num < self.next_spawn_frame:
+            return ()
+        pain = max(gamestate.pain, 0) / gamestate.MAX_PAIN
+        self.next_spawn_frame = gamestate.frame_num + round(self.spawn_interval * (1 + pain))
+        if self.alias_table is None:
+            self.alias_table = build_alias_table(self.weights())
+            self.outcomes_since_build = 0
+        index = sample_alias_table(self.alias_table, self.lesson.rng)
+        self.stats[self.keys[index]].spawn_frames.append(gamestate.frame_num)
+        return (self.lesson.note_at(index, gamestate.note_pool),)
+
+
+# A song played from its file (see song.py). It is never loaded as a whole: its scheduler pulls notes from the file
+# as they come due. Pitches the staff can't show are skipped, and those on both clefs go on the song's clef, the same
+# way the player's notes are routed, so every note on the staff can be hit.
+class SongLesson:
+    has_chords = True  # any beat may be a chord
+
+    def __init__(self, fname, staff, clef=CLEFS[0], key_signature=None):
+        self.fname = os.path.abspath(fname)
+        self.name = self.fname  # session logs and the progress database can then be read from anywhere
+        self.seed = 0  # nothing is random
+        self.clef = clef
+        self.key_signature = key_signature
+        self.pitch_table = staff.pitch_tables[clef]
+        self.skipped_notes = 0
+
+    # (seconds, note_height_ids) per beat with notes on the staff, note_height_ids low to high
+    def entries(self):
+        for event in read_song(self.fname):
+            pitches = {}
+            for midi_note in event.midi_notes:
+                pitch = self.pitch_table[midi_note]
+                if pitch is None:
+                    self.skipped_notes += 1
+                else:
+                    pitches[pitch.height] = pitch
+            if pitches:
+                yield (event.seconds, tuple(pitches[height].note_height_id for height in sorted(pitches, reverse=True)))
+
+    def new_spawn_scheduler(self, staff):
+        return SongSpawnScheduler(self, staff)
+
+
+# Streams a song onto the staff. A beat at t seconds is spawned on frame t * FPS, the first frame it is on screen, at
+# the x it would have scrolled to by then, so every beat crosses the play area line exactly on time (the song starts
+# as the first beat appears at the right edge). Notes leave through the usual thresholds, so memory and per-frame
+# work depend on how many notes fit on the staff, not on how long the song is.
+class SongSpawnScheduler:
+    def __init__(self, lesson, staff):
+        self.entries = lesson.entries()
+        self.next_entry = next(self.entries, None)
+        self.spawn_x = staff.STAFF_TOP_RIGHT_CORNER[0]
+        self.x_thresh = staff.CLEF_PLAY_AREA_POS[0]
+        self.collision_thresh = staff.NOTE_X_RADIUS
+
+    def spawn(self, gamestate):
+        notes = []
+        while self.next_entry is not None:
+            (seconds, note_height_ids) = self.next_entry
+            frames_late = gamestate.frame_num - seconds * FPS
+            if frames_late < 0:
+                break
+            x_init = self.spawn_x + frames_late * BasicEnemyNote.ENEMY_NOTE_SPEED
+            if len(note_height_ids) == 1:
+                notes.append(gamestate.note_pool.acquire(BasicEnemyNote, x_init, note_height_ids[0], self.x_thresh,
+                                                         self.collision_thresh, False))
+            else:
+                notes.append(gamestate.note_pool.acquire(ChordEnemyNote, x_init, note_height_ids, self.x_thresh,
+                                                         self.collision_thresh, False))
+            self.next_entry = next(self.entries, None)
+        return notes
+
+
+# The pain tint covers the whole screen, so it steps through PAIN_TINT_LEVELS alphas instead of following pain
+# frame by frame: DirtyRectRenderer only has to redraw the whole screen when the step changes, a few times per
+# mistake rather than on every frame of the fade.
+PAIN_TINT_LEVELS = 4
+
+
+def pain_tint(pain):
+    if pain <= 0:
+        return 0
+    step = GameState.MAX_PAIN / PAIN_TINT_LEVELS
+    return round(math.ceil(pain / step) * step)
 
 
 class GameState():
     SCORE_FONT_SIZE = 24
     SCORE_POSITION = [SCREEN_WIDTH / 2, SCREEN_HEIGHT / 16]
     SPAWN_SPEED = 25  # #frames between spawns
+    CHORD_WINDOW_FRAMES = CHORD_WINDOW_MS / FRAME_MS
 
     PAIN_PER_FUCKUP = 18
     PAIN_FADE_SPEED = 3
@@ -272,14 +818,47 @@ class GameState():
         self.pain = 0
         self.needs_first = True
         self.had_collision = False
+        self.collision_index = NoteCollisionIndex()
+        self.note_pool = NotePool()
+        self.profiler = NULL_PROFILER
+        self.input_recorder = None
+        self.spawn_scheduler = lesson.new_spawn_scheduler(staff)
+        self.bus = EventBus()
+        # notes of the chord being played, see add_to_chord
+        self.chord_pitches = []
+        self.chord_velocity = 0
+        self.chord_played_at = 0.0
+        # overlapping notes are routed to the clef the lesson is written in
+        self.pitch_table = staff.pitch_tables[lesson.clef]
+        self.bus.subscribe(TOPIC_SIDE_EFFECT, self.update_score)
+        self.bus.subscribe(TOPIC_SIDE_EFFECT, self.update_pain)
+        self.score_texts = {}  # by layout scale
         self.SCORE_POSITION = [staff.STAFF_POS[0] + staff.STAFF_WIDTH / 2, staff.STAFF_HEIGHT / 12]
 
 
     def update(self):
+        if self.chord_pitches and self.frame_num - self.chord_played_at >= self.CHORD_WINDOW_FRAMES:
+            self.shoot_chord()
         self.frame_num += 1
 
         self.spawn_enemy_notes()
 
+        self.profiler.begin("update.movement")
+        self.move_notes()
+        self.profiler.end("update.movement")
+
+        self.profiler.begin("update.collision")
+        self.resolve_collisions()
+        self.profiler.end("update.collision")
+
+        self.profiler.begin("update.destruction")
+        self.destroy_notes()
+        self.profiler.end("update.destruction")
+
+        if self.pain > 0:
+            self.pain -= self.PAIN_FADE_SPEED
+
+    def move_notes(self):
         need_to_set_first = True
         for (id, note) in self.player_notes.items():
             note.update()
@@ -289,11 +868,12 @@ class GameState():
                 note.set_is_first(True)
                 need_to_set_first = False
 
-        # TODO efficientize
+    def resolve_collisions(self):
+        self.collision_index.rebuild(self.enemy_notes)
         for (player_note_id, player_note) in self.player_notes.items():
-            for (enemy_note_id, enemy_note) in self.enemy_notes.items():
-                enemy_note.try_interact(player_note)
+            self.collision_index.try_interact(player_note)
 
+    def destroy_notes(self):
         player_notes_to_destroy = []
         enemy_notes_to_destroy = []
         side_effects = []
@@ -302,86 +882,136 @@ class GameState():
             side_effect = note.should_destroy
             if side_effect:
                 player_notes_to_destroy.append(id)
-                side_effects.append(side_effect)
+                side_effects.append((side_effect, note.note_height_id))
 
         for (id, note) in self.enemy_notes.items():
             side_effect = note.should_destroy
             if side_effect:
                 enemy_notes_to_destroy.append(id)
-                side_effects.append(side_effect)
+                side_effects.append((side_effect, note.note_height_id))
 
         for id in player_notes_to_destroy:
-            del self.player_notes[id]
+            self.note_pool.release(self.player_notes.pop(id))
 
         for id in enemy_notes_to_destroy:
-            del self.enemy_notes[id]
-
-        for side_effect in side_effects:
-            self.do_side_effect(side_effect)
-
-        if self.pain > 0:
-            self.pain -= self.PAIN_FADE_SPEED
+            self.note_pool.release(self.enemy_notes.pop(id))
 
+        for (side_effect, note_height_id) in side_effects:
+            self.do_side_effect(side_effect, note_height_id)
 
     def spawn_enemy_notes(self):
-        if self.frame_num % self.SPAWN_SPEED == 0:
-            self.register_enemy_note(self.lesson.new_note())
+        for note in self.spawn_scheduler.spawn(self):
+            self.bus.publish(TOPIC_NOTE_SPAWNED, note.note_height_ids, self.frame_num)
+            self.register_enemy_note(note)
 
     def add_pain(self, pain):
         self.pain += pain
         if self.pain > self.MAX_PAIN:  # popular franchise from Remedy Games
             self.pain = self.MAX_PAIN
 
-    def do_side_effect(self, side_effect: NoteCollisionSideEffect):
-        print(side_effect)
-        if side_effect == NoteCollisionSideEffect.NONE:
-            return
-        elif side_effect == NoteCollisionSideEffect.SUCCESSFUL_COLLISION_ENEMY:
-            self.score += 1
-        elif side_effect == NoteCollisionSideEffect.ENEMY_NOTE_GOT_THROUGH:
-            self.score -= 5
-            self.add_pain(3 * self.PAIN_PER_FUCKUP)
-        elif side_effect == NoteCollisionSideEffect.PLAYER_MISSED_ALL:
-            self.score -= 1
-            self.add_pain(2 * self.PAIN_PER_FUCKUP)
-        elif side_effect == NoteCollisionSideEffect.COLLISION_NOT_FIRST_NOTE:
-            self.score -= 2
-            self.add_pain(2 * self.PAIN_PER_FUCKUP)
-        return
+    # Side effects are published on the bus; score and pain are just two of its subscribers
+    def do_side_effect(self, side_effect: NoteCollisionSideEffect, note_height_id=None):
+        self.bus.publish(TOPIC_SIDE_EFFECT, SideEffect(side_effect, note_height_id), self.frame_num)
+
+    SCORE_PER_SIDE_EFFECT = {
+        NoteCollisionSideEffect.SUCCESSFUL_COLLISION_ENEMY: 1,
+        NoteCollisionSideEffect.ENEMY_NOTE_GOT_THROUGH: -5,
+        NoteCollisionSideEffect.PLAYER_MISSED_ALL: -1,
+        NoteCollisionSideEffect.COLLISION_NOT_FIRST_NOTE: -2,
+    }
+    PAIN_PER_SIDE_EFFECT = {
+        NoteCollisionSideEffect.ENEMY_NOTE_GOT_THROUGH: 3 * PAIN_PER_FUCKUP,
+        NoteCollisionSideEffect.PLAYER_MISSED_ALL: 2 * PAIN_PER_FUCKUP,
+        NoteCollisionSideEffect.COLLISION_NOT_FIRST_NOTE: 2 * PAIN_PER_FUCKUP,
+    }
+
+    def update_score(self, event):
+        self.score += self.SCORE_PER_SIDE_EFFECT.get(event.payload.side_effect, 0)
+
+    def update_pain(self, event):
+        pain = self.PAIN_PER_SIDE_EFFECT.get(event.payload.side_effect)
+        if pain:
+            self.add_pain(pain)
 
     def draw_note_collection(self, surf, staff):
+        rects = []
         for (id, note) in self.enemy_notes.items():
-            note.draw(surf, staff)
+            rects.append(note.draw(surf, staff))
 
         for (id, note) in self.player_notes.items():
-            note.draw(surf, staff)
+            rects.append(note.draw(surf, staff))
+        return rects
 
     antialias_score = True
     score_color = (255, 0, 0)
 
-    def draw_score(self, surf):
-        my_ft_font = pg.font.SysFont('Times New Roman', self.SCORE_FONT_SIZE)
-        text_surface = my_ft_font.render(f"Score: {self.score}", self.antialias_score, self.score_color)
-        surf.blit(text_surface, self.SCORE_POSITION)
+    # staff is the one being drawn on, which may be laid out for a different window size than self.staff
+    def draw_score(self, surf, staff=None):
+        layout = (staff or self.staff).layout
+        score_text = self.score_texts.get(layout.scale)
+        if score_text is None:
+            score_text = self.score_texts[layout.scale] = \
+                TextRenderer('Times New Roman', layout.length(self.SCORE_FONT_SIZE), self.antialias_score)
+        return score_text.draw(surf, f"Score: {self.score}", self.score_color, layout.point(self.SCORE_POSITION))
 
     def draw_pain(self, surf):
-        surf.fill((255, 0, 0, self.pain))
-
-    def draw(self, surf):
-        self.draw_pain(surf)
-        self.draw_note_collection(surf, self.staff)
-        self.draw_score(surf)
-
-    # If we have overlapping notes from the bass and treble clef, send to the right clef
-    def get_shot_clef(self, ansi_note):
-        return "TREBLE"  # TODO
-
-    def send_ansi_note(self, ansi_note):
-        clef = self.get_shot_clef(ansi_note)
-        note_height_id = f"{ansi_note}_{clef}" #TODO, be more sophisticated
-        if note_height_id in staff.display_heights:
-            shot = PlayerShot(note_height_id, 999, staff.CLEF_PLAY_AREA_POS[0], staff.STAFF_TOP_RIGHT_CORNER[0])
-            self.register_player_note(shot)
+        return surf.fill((255, 0, 0, pain_tint(self.pain)))
+
+    # returns the rects that were drawn to
+    def draw(self, surf, staff=None):
+        staff = staff or self.staff
+        rects = [self.draw_pain(surf)]
+        rects.extend(self.draw_note_collection(surf, staff))
+        rects.append(self.draw_score(surf, staff))
+        return rects
+
+    # Entry point for all player input; goes through the recorder (see replay.py) when one is attached.
+    # frame_offset is how many frames ago (0 to 1) the note was actually played; the shot starts that far along.
+    def send_midi_note(self, midi_note, velocity=MIDI_MAX_VELOCITY, frame_offset=0.0):
+        if self.input_recorder:
+            self.input_recorder.record_note(self.frame_num, midi_note, velocity, frame_offset)
+        self.bus.publish(TOPIC_NOTE_PLAYED, NotePlayed(midi_note, velocity), self.frame_num)
+        pitch = self.pitch_table[midi_note]
+        if pitch is None:
+            return
+        if self.lesson.has_chords:
+            self.add_to_chord(pitch, velocity, frame_offset)
+        else:
+            self.shoot(pitch, velocity, frame_offset)
+
+    def send_ansi_note(self, ansi_note, frame_offset=0.0, velocity=MIDI_MAX_VELOCITY):
+        self.send_midi_note(ansi_note_to_midi(ansi_note), velocity, frame_offset)
+
+    def shoot(self, pitch, velocity, frame_offset):
+        x_init = self.staff.CLEF_PLAY_AREA_POS[0] + PlayerShot.PLAYER_SHOT_SPEED * frame_offset
+        shot = self.note_pool.acquire(PlayerShot, pitch.note_height_id, velocity, x_init,
+                                      self.staff.STAFF_TOP_RIGHT_CORNER[0])
+        self.register_player_note(shot)
+
+    # Chord lessons hold notes back for CHORD_WINDOW_FRAMES after the first one (measured from when they were played,
+    # not when they were polled), then shoot everything played in that window as one chord
+    def add_to_chord(self, pitch, velocity, frame_offset):
+        played_at = self.frame_num - frame_offset
+        if self.chord_pitches and played_at - self.chord_played_at >= self.CHORD_WINDOW_FRAMES:
+            self.shoot_chord()
+        if not self.chord_pitches:
+            self.chord_played_at = played_at
+            self.chord_velocity = 0
+        self.chord_pitches.append(pitch)
+        self.chord_velocity = max(self.chord_velocity, velocity)
+
+    def shoot_chord(self):
+        pitches = sorted({pitch.height: pitch for pitch in self.chord_pitches}.values(),
+                         key=lambda pitch: -pitch.height)
+        frame_offset = self.frame_num - self.chord_played_at
+        self.chord_pitches = []
+        if len(pitches) == 1:
+            self.shoot(pitches[0], self.chord_velocity, frame_offset)
+            return
+        x_init = self.staff.CLEF_PLAY_AREA_POS[0] + PlayerShot.PLAYER_SHOT_SPEED * frame_offset
+        shot = self.note_pool.acquire(ChordShot, tuple(pitch.note_height_id for pitch in pitches), self.chord_velocity,
+                                      x_init, self.staff.STAFF_TOP_RIGHT_CORNER[0])
+        self.register_player_note(shot)
 
     def register_player_note(self, note):
         self.player_notes[self.latest_note_id] = note
@@ -393,6 +1023,8 @@ class GameState():
 
 
 class Note:
+    __slots__ = ()
+
     @abc.abstractmethod
     def update(self):
         pass
@@ -405,22 +1037,20 @@ class Note:
     def note_real_value(self):
         pass
 
-    def draw_extra_line(self, surf, height):
-        draw_line_horizontal(surf, self.note_color, [self.x_position - staff.NOTE_X_RADIUS * 1.5,
-                                                     height - 1.5 * LINE_WEIGHT_STANDARD / 2],
-                             staff.NOTE_X_RADIUS * 3.25, 1.5 * LINE_WEIGHT_STANDARD)
+    # the pitches making up the note, more than one for chords
+    @property
+    def note_height_ids(self):
+        return (self.note_height_id,)
 
     def draw(self, surf, staff):
         note_height = staff.display_heights[self.note_height_id]
-        draw_ellipse_angle(surf, self.note_color, staff.get_note_rect(self.x_position, note_height),
-                           20)  # TODO: DRY/Refactor
-        extra_lines = staff.extra_line_heights.get(self.note_height_id)
-        if extra_lines:
-            for line in extra_lines:
-                self.draw_extra_line(surf, line)
+        sprite, offset = staff.note_sprites.get(self.note_color, self.note_height_id)
+        x = staff.x_offset + self.x_position * staff.x_scale
+        return surf.blit(sprite, (x + offset[0], note_height + offset[1]))
 
 
 class PlayerShot(Note):
+    __slots__ = ("lines_around", "line_through", "x_thresh", "note_height_id", "midi_vel", "x_position", "side_effect")
     PLAYER_SHOT_SPEED = 25
 
     @property
@@ -428,6 +1058,9 @@ class PlayerShot(Note):
         return self.note_height_id
 
     def __init__(self, note_height_id, midi_vel, x_init, x_thresh, line_through=False, lines_around=0):
+        self.reset(note_height_id, midi_vel, x_init, x_thresh, line_through, lines_around)
+
+    def reset(self, note_height_id, midi_vel, x_init, x_thresh, line_through=False, lines_around=0):
         self.lines_around = lines_around
         self.line_through = line_through
         self.x_thresh = x_thresh
@@ -445,7 +1078,7 @@ class PlayerShot(Note):
     def should_destroy(self):
         return self.side_effect
 
-    note_color = (0, 125, 0, 255)
+    note_color = PLAYER_NOTE_COLOR
 
 
 
@@ -454,15 +1087,21 @@ class PlayerShot(Note):
 
 
 class BasicEnemyNote(Note):
+    __slots__ = ("x_thresh", "note_height_id", "x_position", "side_effect", "collision_thresh", "is_first",
+                 "note_color")
+    ENEMY_NOTE_SPEED = -3
+
     def __init__(self, x_init, note_height_id, x_thresh, collision_thresh, is_first):
+        self.reset(x_init, note_height_id, x_thresh, collision_thresh, is_first)
+
+    def reset(self, x_init, note_height_id, x_thresh, collision_thresh, is_first):
         self.x_thresh = x_thresh
-        self.ENEMY_NOTE_SPEED = -3
         self.note_height_id = note_height_id
         self.x_position = x_init
         self.side_effect = None
         self.collision_thresh = collision_thresh
         self.is_first = False
-        self.note_color = (255, 0, 0, 255) if(is_first) else (128, 0, 255, 255)
+        self.note_color = FIRST_ENEMY_NOTE_COLOR if(is_first) else ENEMY_NOTE_COLOR
 
     @property
     def note_real_value(self):
@@ -474,7 +1113,7 @@ class BasicEnemyNote(Note):
 
     def set_is_first(self, is_first):
         self.is_first = is_first
-        self.note_color = (255, 0, 0, 255)
+        self.note_color = FIRST_ENEMY_NOTE_COLOR
 
     def update(self):
         self.x_position += self.ENEMY_NOTE_SPEED
@@ -497,6 +1136,150 @@ class BasicEnemyNote(Note):
                self.x_position < player_note.x_position
 
 
+# Chords are drawn as one head per pitch but collide as a single note: their note_height_id is the chord's pitches
+# joined low to high, as chords are written, e.g. "C4_TREBLE+E4_TREBLE+G4_TREBLE" (heights count down the staff, so
+# that is by descending height), so a chord shot is matched against enemy chords in one collision test and only hits
+# the exact same chord.
+def chord_note_height_id(note_height_ids):
+    return CHORD_SEPARATOR.join(note_height_ids)
+
+
+class ChordNote(Note):
+    __slots__ = ()
+
+    def draw(self, surf, staff):
+        x = staff.x_offset + self.x_position * staff.x_scale
+        rect = None
+        for note_height_id in self.note_height_ids:
+            sprite, offset = staff.note_sprites.get(self.note_color, note_height_id)
+            head_rect = surf.blit(sprite, (x + offset[0], staff.display_heights[note_height_id] + offset[1]))
+            rect = head_rect if rect is None else rect.union(head_rect)
+        return rect
+
+
+class ChordShot(ChordNote, PlayerShot):
+    __slots__ = ("note_height_ids",)
+
+    def __init__(self, note_height_ids, midi_vel, x_init, x_thresh):
+        self.reset(note_height_ids, midi_vel, x_init, x_thresh)
+
+    def reset(self, note_height_ids, midi_vel, x_init, x_thresh):
+        super().reset(chord_note_height_id(note_height_ids), midi_vel, x_init, x_thresh)
+        self.note_height_ids = note_height_ids
+
+
+class ChordEnemyNote(ChordNote, BasicEnemyNote):
+    __slots__ = ("note_height_ids",)
+
+    def __init__(self, x_init, note_height_ids, x_thresh, collision_thresh, is_first):
+        self.reset(x_init, note_height_ids, x_thresh, collision_thresh, is_first)
+
+    def reset(self, x_init, note_height_ids, x_thresh, collision_thresh, is_first):
+        super().reset(x_init, chord_note_height_id(note_height_ids), x_thresh, collision_thresh, is_first)
+        self.note_height_ids = note_height_ids
+
+
+# Frozen copies of notes for FrameSnapshot. They draw exactly like the notes they were taken from.
+class NoteSnapshot(Note):
+    __slots__ = ("x_position", "note_height_id", "note_color")
+
+    def __init__(self, note):
+        self.x_position = note.x_position
+        self.note_height_id = note.note_height_id
+        self.note_color = note.note_color
+
+
+class ChordNoteSnapshot(ChordNote):
+    __slots__ = ("x_position", "note_height_id", "note_height_ids", "note_color")
+
+    def __init__(self, note):
+        self.x_position = note.x_position
+        self.note_height_id = note.note_height_id
+        self.note_height_ids = note.note_height_ids
+        self.note_color = note.note_color
+
+
+def snapshot_note(note):
+    return ChordNoteSnapshot(note) if isinstance(note, ChordNote) else NoteSnapshot(note)
+
+
+# Everything the renderers read from a GameState, copied at the end of an update so the frame can be drawn while
+# the next one is simulated (see SimulationPipeline). Drawing goes through GameState's own draw methods, so a
+# snapshot renders pixel for pixel like the gamestate it was taken from did.
+class FrameSnapshot:
+    def __init__(self, gamestate):
+        self.staff = gamestate.staff
+        self.frame_num = gamestate.frame_num
+        self.score = gamestate.score
+        self.pain = gamestate.pain
+        self.enemy_notes = {id: snapshot_note(note) for (id, note) in gamestate.enemy_notes.items()}
+        self.player_notes = {id: snapshot_note(note) for (id, note) in gamestate.player_notes.items()}
+        # score text settings and surfaces, only ever used on the rendering thread
+        self.score_texts = gamestate.score_texts
+        self.SCORE_FONT_SIZE = gamestate.SCORE_FONT_SIZE
+        self.SCORE_POSITION = gamestate.SCORE_POSITION
+        self.antialias_score = gamestate.antialias_score
+        self.score_color = gamestate.score_color
+        self.simulate_seconds = 0.0
+
+    draw_note_collection = GameState.draw_note_collection
+    draw_score = GameState.draw_score
+    draw_pain = GameState.draw_pain
+    draw = GameState.draw
+
+
+# Runs input handling and GameState.update on a worker thread, one frame ahead of rendering: submit() hands the
+# worker the next frame's work and returns immediately, so the main thread can draw the previous frame's snapshot
+# while the worker simulates. pygame releases the GIL in blits and display updates, which is where the overlap
+# comes from. All bus traffic happens on the worker, in the same order as in the sequential loop.
+class SimulationPipeline:
+    def __init__(self, gamestate):
+        self.gamestate = gamestate
+        self.jobs = queue.SimpleQueue()
+        self.snapshots = queue.SimpleQueue()
+        self.snapshots.put(FrameSnapshot(gamestate))
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # input_events are pygame events to publish, midi_notes (midi_note, velocity, frame_offset) tuples to play
+    def submit(self, steps, input_events=(), midi_notes=()):
+        self.jobs.put((steps, input_events, midi_notes))
+
+    # the snapshot of the last submitted frame, waiting for the worker to finish it if need be
+    def wait(self):
+        snapshot = self.snapshots.get()
+        if isinstance(snapshot, BaseException):
+            raise snapshot
+        return snapshot
+
+    def run(self):
+        gamestate = self.gamestate
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            (steps, input_events, midi_notes) = job
+            start = time.perf_counter()
+            try:
+                for event in input_events:
+                    gamestate.bus.publish(TOPIC_INPUT, event, gamestate.frame_num)
+                for (midi_note, velocity, frame_offset) in midi_notes:
+                    gamestate.send_midi_note(midi_note, velocity, frame_offset)
+                for _ in range(steps):
+                    gamestate.update()
+                snapshot = FrameSnapshot(gamestate)
+            except Exception as e:
+                self.snapshots.put(e)
+                return
+            snapshot.simulate_seconds = time.perf_counter() - start
+            self.snapshots.put(snapshot)
+
+    # lets the worker finish what it was given; the gamestate is the main thread's again afterwards
+    def stop(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+
 def new_surface():
     surface = pg.Surface(screen.get_size(), pg.SRCALPHA)
     surface = surface.convert_alpha()
@@ -507,107 +1290,438 @@ def draw_ellipse_angle(surf, color, rect, angle):
     shape_surf = pg.Surface(rect.size, pg.SRCALPHA)
     pg.draw.ellipse(shape_surf, color, (0, 0, rect.width, rect.height))
     rotated_surf = pg.transform.rotate(shape_surf, angle)
-    surf.blit(rotated_surf, rotated_surf.get_rect(center=rect.center))
+    return surf.blit(rotated_surf, rotated_surf.get_rect(center=rect.center))
 
 
-def init_midi():
-    pg.fastevent.init()
-    event_get = pg.fastevent.get
-    event_post = pg.fastevent.post
-    pg.midi.init()
-
-    input_id = pg.midi.get_default_input_id()
+# Composites the note overlay onto the pre-rendered staff and presents the whole screen every frame
+# overlays are extra draw(surf) -> rect callables drawn on top, e.g. the profiler overlay.
+# staff is the staff laid out for the screen (and that background was rendered from); the gamestate's by default.
+class FullFrameRenderer:
+    def __init__(self, screen, background, profiler=NULL_PROFILER, staff=None):
+        self.screen = screen
+        self.background = background
+        self.staff = staff
+        self.note_surface = new_surface()
+        self.profiler = profiler
+        self.overlays = []
 
-    i = pg.midi.Input(input_id)
-    return (event_get, event_post, i)
+    def invalidate(self):
+        pass
 
+    def render(self, gamestate):
+        self.profiler.begin("draw")
+        self.note_surface.fill((255, 255, 255, 0))
+        gamestate.draw(self.note_surface, self.staff)
+        for overlay in self.overlays:
+            overlay(self.note_surface)
+        self.profiler.end("draw")
+
+        self.profiler.begin("present")
+        self.screen.blit(self.background, (0, 0))
+        self.screen.blit(self.note_surface, (0, 0))
+        pg.display.flip()
+        self.profiler.end("present")
+
+
+# Draws notes and the score straight onto the screen and only pushes the regions that changed since the last frame:
+# last frame's rects are restored from the staff background, this frame's are drawn, and both go to
+# pg.display.update. The pain tint is composed into a copy of the background once per tint level (see pain_tint), so
+# restoring is always an opaque blit and only a frame where the level changes is a full redraw.
+# background must already be in the display's format (Staff.get_surface's is); it is used as is, so renderers can
+# share one.
+class DirtyRectRenderer:
+    def __init__(self, screen, background, profiler=NULL_PROFILER, staff=None):
+        self.screen = screen
+        self.background = background
+        self.tinted_background = self.background
+        self.staff = staff
+        self.pain_surface = pg.Surface(screen.get_size(), pg.SRCALPHA)
+        self.profiler = profiler
+        self.overlays = []
+        self.last_rects = []
+        self.last_tint = 0
+        self.full_redraw = True
+
+    def invalidate(self):
+        self.full_redraw = True
+
+    # pushes the regions of the screen that changed to the display
+    def present(self, rects):
+        pg.display.update(rects)
+
+    def tint_background(self, tint):
+        if not tint:
+            return self.background
+        tinted = self.background.copy()
+        self.pain_surface.fill((255, 0, 0, tint))
+        tinted.blit(self.pain_surface, (0, 0))
+        return tinted
+
+    def render(self, gamestate):
+        self.profiler.begin("draw")
+        tint = pain_tint(gamestate.pain)
+        if tint != self.last_tint:
+            self.tinted_background = self.tint_background(tint)
+            self.full_redraw = True
+
+        if self.full_redraw:
+            screen_rect = self.screen.get_rect()
+            self.screen.blit(self.tinted_background, screen_rect, screen_rect)
+            dirty = [screen_rect]
+        else:
+            for rect in self.last_rects:
+                self.screen.blit(self.tinted_background, rect, rect)
+            dirty = self.last_rects
+
+        staff = self.staff or gamestate.staff
+        rects = gamestate.draw_note_collection(self.screen, staff)
+        rects.append(gamestate.draw_score(self.screen, staff))
+        for overlay in self.overlays:
+            rects.append(overlay(self.screen))
+        self.profiler.end("draw")
+
+        self.profiler.begin("present")
+        self.present(dirty + rects)
+        self.profiler.end("present")
+        self.last_rects = rects
+        self.last_tint = tint
+        self.full_redraw = False
+
+
+DIRTY_RECT_RENDERING = True
+
+
+# A staff laid out for the screen's size, and a renderer drawing onto it. Built once per window size: the staff
+# surface and the note sprites are rendered at native resolution, so frames cost the same at any size.
+def new_renderer(screen, profiler=NULL_PROFILER):
+    size = screen.get_size()
+    screen_staff = Staff(StaffLayout(size))
+    background = screen_staff.get_surface(size)
+    if DIRTY_RECT_RENDERING:
+        return DirtyRectRenderer(screen, background, profiler, screen_staff)
+    return FullFrameRenderer(screen, background, profiler, screen_staff)
+
+
+MidiNoteOn = namedtuple("MidiNoteOn", ["status", "data1", "data2", "timestamp"])
+
+
+# Drains the MIDI device continuously on its own thread, so a key press waits neither for the next frame's poll
+# nor behind a burst of other events. Note-ons are queued with their portmidi timestamps (ms, same clock as
+# pg.midi.time()) for the frame loop to pick up with drain().
+class MidiInputThread(threading.Thread):
+    POLL_INTERVAL = 0.001
+    READ_BUFFER_SIZE = 64
+
+    def __init__(self, midi_in):
+        super().__init__(daemon=True)
+        self.midi_in = midi_in
+        self.events = queue.SimpleQueue()
+        self.running = True
+
+    def run(self):
+        while self.running:
+            if not self.midi_in.poll():
+                time.sleep(self.POLL_INTERVAL)
+                continue
+            for ((status, data1, data2, data3), timestamp) in self.midi_in.read(self.READ_BUFFER_SIZE):
+                if status == MIDI_KEY_DOWN and data2 > 0:  # a note-on with velocity 0 is a note-off
+                    self.events.put(MidiNoteOn(status, data1, data2, timestamp))
+
+    def drain(self):
+        res = []
+        while True:
+            try:
+                res.append(self.events.get_nowait())
+            except queue.Empty:
+                return res
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+# "1920x1080" -> (1920, 1080)
+def parse_size(size):
+    try:
+        (width, height) = (int(length) for length in size.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected WIDTHxHEIGHT, got {size!r}")
+    return (width, height)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lesson", default="lesson_4",
+                        help="lesson name or number, or a song file (.song, .mid) to play along to")
+    parser.add_argument("--seed", type=int, help="seed for the lesson's note choices (random by default)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="spawn more of the notes the player gets wrong, at a rate that adapts to how they're "
+                             "doing")
+    parser.add_argument("--record", metavar="FILE", help="record the session for replay.py")
+    parser.add_argument("--mute", action="store_true", help="don't sound notes")
+    parser.add_argument("--student", help="save the session's results to the progress database under this name")
+    parser.add_argument("--progress-db", metavar="FILE", help="progress database (default: progress.sqlite3)")
+    parser.add_argument("--log", metavar="FILE", default="-",
+                        help="log input events and side effects to FILE, '-' for stdout (the default)")
+    parser.add_argument("--no-log", action="store_true", help="don't log events")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="time each stage of the frame loop and write the results to FILE (.csv or .json) at exit")
+    parser.add_argument("--profile-overlay", action="store_true",
+                        help="show frame timings on screen (toggle with F3)")
+    parser.add_argument("--pipelined", action="store_true",
+                        help="simulate the next frame on a worker thread while the current one is drawn")
+    parser.add_argument("--size", type=parse_size, default=(SCREEN_WIDTH, SCREEN_HEIGHT), metavar="WIDTHxHEIGHT",
+                        help=f"initial window size (default: {SCREEN_WIDTH}x{SCREEN_HEIGHT}); the window is resizable")
+    parser.add_argument("--fullscreen", action="store_true", help="fill the screen at its native resolution")
+    parser.add_argument("--autoplay", type=float, metavar="ACCURACY",
+                        help="play with headless.py's autoplayer instead of a MIDI keyboard")
+    parser.add_argument("--frames", type=int, help="run this many frames as fast as possible, then quit")
+    args = parser.parse_args()
+    # the autoplayer reads the gamestate, which belongs to the worker thread while it simulates
+    if args.autoplay is not None and args.pipelined:
+        parser.error("--autoplay can't be combined with --pipelined")
+    return args
 
-MIDI_KEY_DOWN = 144
 
+def init_midi():
+    pg.midi.init()
 
-def handle_midi_in(event):
-    if event.status == MIDI_KEY_DOWN:
-        ansi_note = pg.midi.midi_to_ansi_note(event.data1)
-        gamestate.send_ansi_note(ansi_note)
+    input_id = pg.midi.get_default_input_id()
 
+    midi_thread = MidiInputThread(pg.midi.Input(input_id))
+    midi_thread.start()
+    return midi_thread
 
-def read_lesson_contents(lesson_no):
-    res = []
-    fname = f"./lessons/lesson_{lesson_no}.txt"
-    with open(fname) as f:
-        for line in f:
-            res.append(line.strip())
-    return res
 
+# How far into the past (in frames, at most one) a MIDI timestamp is, relative to now
+def midi_frame_offset(timestamp, now):
+    offset = min(max((now - timestamp) / FRAME_MS, 0.0), 1.0)
+    return round(offset * FRAME_OFFSET_STEPS) / FRAME_OFFSET_STEPS
 
-if __name__ == '__main__':
 
-    # Pre-render staff surface
-    staff_surface = new_surface()
-    staff_surface.fill((255, 255, 255, 255))
+def handle_midi_in(event, frame_offset=0.0):
+    if event.status == MIDI_KEY_DOWN:
+        gamestate.send_midi_note(event.data1, event.data2, frame_offset)
+
+
+def new_lesson_registry(staff):
+    return LessonRegistry(staff.note_height_ids, os.path.join(main_dir, "lessons"))
+
+
+# lesson is a lesson name ("lesson_4") or, for short, its number, or the path of a song file
+def load_lesson(staff, lesson, key_signature=None, registry=None, seed=None):
+    if isinstance(lesson, str) and lesson.lower().endswith(SONG_SUFFIXES):
+        # a relative path is tried from the working directory, then from the game's, like songs/ode_to_joy.song
+        if not os.path.exists(lesson):
+            lesson = os.path.join(main_dir, lesson)
+        return SongLesson(lesson, staff, key_signature=key_signature)
+    registry = registry or new_lesson_registry(staff)
+    if isinstance(lesson, int) or lesson.isdigit():
+        lesson = f"lesson_{lesson}"
+    compiled = registry.get(lesson)
+    notes = []
+    for heights in lesson_entries(compiled):
+        note_height_ids = tuple(compiled.note_height_ids[i] for i in heights)
+        if len(note_height_ids) == 1:
+            notes.append(BasicEnemyNote(staff.STAFF_TOP_RIGHT_CORNER[0], note_height_ids[0],
+                                        staff.CLEF_PLAY_AREA_POS[0], staff.NOTE_X_RADIUS, is_first=False))
+        else:
+            notes.append(ChordEnemyNote(staff.STAFF_TOP_RIGHT_CORNER[0], note_height_ids,
+                                        staff.CLEF_PLAY_AREA_POS[0], staff.NOTE_X_RADIUS, is_first=False))
+    return RandomLesson(notes, key_signature, seed, compiled.name)
+
+
+# Simulation runs at a fixed logical rate of FPS updates per second, independent of how long rendering takes.
+# advance() is fed wall-clock milliseconds and returns how many updates are due.
+class FixedTimestep:
+    def __init__(self, step_ms=FRAME_MS, max_steps=MAX_FRAMES_PER_TICK):
+        self.step_ms = step_ms
+        self.max_steps = max_steps
+        self.accumulator = 0
+
+    def advance(self, elapsed_ms):
+        self.accumulator += elapsed_ms
+        steps = int(self.accumulator // self.step_ms)
+        self.accumulator -= steps * self.step_ms
+        if steps > self.max_steps:
+            steps = self.max_steps
+            self.accumulator = 0
+        return steps
+
+
+# The game as run from the command line. main.py runs it through "import main" rather than as __main__, so there
+# is one copy of the module: progress_store, replay and synth import main too, and would otherwise get classes (like
+# NoteCollisionSideEffect) that never compare equal to the ones the game uses.
+def run():
+    global screen, gamestate
+    args = parse_args()
+    display_flags = FULLSCREEN if args.fullscreen else RESIZABLE
+    init_display((0, 0) if args.fullscreen else args.size, display_flags)
+
+    # the simulation's staff, in design coordinates; the renderer has its own laid out for the window
     staff = Staff()
-    staff.draw(staff_surface)
 
     # TODO this is shit
     key_signature = None
-    lesson_no = 4
-    lesson_contents = read_lesson_contents(lesson_no)
-    notes = [BasicEnemyNote(staff.STAFF_TOP_RIGHT_CORNER[0], note_height_id, staff.CLEF_PLAY_AREA_POS[0],
-                            staff.NOTE_X_RADIUS, is_first=False)
-             for note_height_id in lesson_contents]
-
-    lesson = RandomLesson(notes, key_signature)
+    lesson = load_lesson(staff, args.lesson, key_signature, seed=args.seed)
 
     gamestate = GameState(staff, lesson)
-    note_surface = new_surface()
+    if args.adaptive:
+        gamestate.spawn_scheduler = AdaptiveSpawnScheduler(gamestate)
+    log_writer = None
+    if not args.no_log:
+        log_writer = AsyncLogWriter(None if args.log == "-" else open(args.log, "a"))
+        gamestate.bus.subscribe(None, log_writer)
+    if args.record:
+        from replay import SessionRecorder
+        gamestate.input_recorder = SessionRecorder(args.record, lesson.seed, lesson.name, args.adaptive)
+    if not args.mute:
+        import synth
+        try:
+            synth.init_mixer()
+            synth.Synth(staff).attach(gamestate.bus)
+        except pg.error as e:
+            print(f"no sound: {e}")
+    progress = None
+    if args.student:
+        from progress_store import DEFAULT_DB, ProgressStore, SessionTally
+        progress = ProgressStore(args.progress_db or DEFAULT_DB)
+        session_tally = SessionTally(gamestate, args.student)
+    profiler = FrameProfiler() if args.profile or args.profile_overlay else NULL_PROFILER
+    pipeline = None
+    if args.pipelined:
+        # the profiler belongs to the main thread; the worker's time is reported per frame as "simulate"
+        pipeline = SimulationPipeline(gamestate)
+    else:
+        gamestate.profiler = profiler
+    renderer = new_renderer(screen, profiler)
+
+    show_profile_overlay = args.profile_overlay
+    profile_text = TextRenderer('Courier New', 14)
+
+    def draw_profile_overlay(surf):
+        staff_pos = renderer.staff.STAFF_POS
+        return profiler.draw_overlay(surf, profile_text, (staff_pos[0] + 5, staff_pos[1] + 5))
+    if show_profile_overlay:
+        renderer.overlays.append(draw_profile_overlay)
 
     paused = False
+    resize_to = None
 
-    event_get, event_post, midi_in = init_midi()
+    midi_thread = None
+    player_input = None
+    if args.autoplay is None:
+        midi_thread = init_midi()
+    else:
+        import headless
+        player_input = headless.AutoPlayer(args.autoplay, rng=random.Random(args.seed))
+    frames = 0
+
+    timestep = FixedTimestep()
+    fpsClock.tick()
 
     going = True
     while going:
+        profiler.begin_frame()
 
-        for event in pg.event.get():
-            print(event)
+        profiler.begin("events")
+        input_events = pg.event.get()
+        for event in input_events:
+            if not pipeline:
+                gamestate.bus.publish(TOPIC_INPUT, event, gamestate.frame_num)
             if event.type == QUIT:
                 going = False
             elif event.type == KEYDOWN:
                 if event.key == K_ESCAPE:
                     paused = not paused
-            elif event.type == pg.midi.MIDIIN:
-                if not paused:
-                    handle_midi_in(event)
-
-        if midi_in.poll():
-            midi_events = midi_in.read(10)
-            # convert them into pygame events.
-            midi_evs = pg.midi.midis2events(midi_events, midi_in.device_id)
-
-            for m_e in midi_evs:
-                event_post(m_e)
-
-        if not paused:
-            gamestate.update()
+                elif event.key == K_F3 and profiler.enabled:
+                    show_profile_overlay = not show_profile_overlay
+                    if show_profile_overlay:
+                        renderer.overlays.append(draw_profile_overlay)
+                    else:
+                        renderer.overlays.remove(draw_profile_overlay)
+                        renderer.invalidate()
+            elif event.type == VIDEOEXPOSE:
+                renderer.invalidate()
+            elif event.type == VIDEORESIZE:
+                resize_to = event.size
+        if resize_to:  # dragging the window edge sends a burst of these, only lay out for the last one
+            screen = pg.display.set_mode(resize_to, display_flags, 32)
+            assets.clear_composed()
+            overlays = renderer.overlays
+            renderer = new_renderer(screen, profiler)
+            renderer.overlays = overlays
+            resize_to = None
+        profiler.end("events")
+
+        profiler.begin("midi")
+        midi_now = pg.midi.time() if midi_thread else 0
+        midi_notes = []
+        for midi_event in midi_thread.drain() if midi_thread else []:
+            if paused:
+                continue
+            frame_offset = midi_frame_offset(midi_event.timestamp, midi_now)
+            if pipeline:
+                midi_notes.append((midi_event.data1, midi_event.data2, frame_offset))
+            else:
+                handle_midi_in(midi_event, frame_offset)
+        profiler.end("midi")
+
+        if args.frames is not None:
+            steps = 1  # as fast as possible
+        else:
+            steps = timestep.advance(fpsClock.get_time())
+        if paused:
+            steps = 0
+        if pipeline:
+            # draws last frame's snapshot while the worker simulates this one
+            profiler.begin("sync")
+            frame = pipeline.wait()
+            pipeline.submit(steps, input_events, midi_notes)
+            profiler.end("sync")
+            profiler.record("simulate", frame.simulate_seconds)
+        else:
+            for _ in range(steps):
+                if player_input:
+                    for midi_note in player_input.notes_for_frame(gamestate):
+                        gamestate.send_midi_note(midi_note)
+                gamestate.update()
+            frame = gamestate
         # font = pg.font.Font(None, 36)
         # text = font.render(str(snake.length), 1, (10, 10, 10))
         # textpos = text.get_rect()
         # textpos.centerx = 20
         # surface.blit(text, textpos)
 
-        note_surface.fill((255, 255, 255, 0))
-        gamestate.draw(note_surface)
-
-        screen.blit(staff_surface, (0, 0))
-        screen.blit(note_surface, (0, 0))
+        renderer.render(frame)
+        profiler.end_frame()
+        frames += steps
+        if args.frames is not None:
+            going = going and frames < args.frames
+        else:
+            fpsClock.tick(FPS)
+    # end main game loop
+    if pipeline:
+        pipeline.stop()
+
+    if args.profile:
+        profiler.dump(args.profile)
+    if args.record:
+        gamestate.input_recorder.close(gamestate.frame_num)
+    if log_writer:
+        log_writer.close()
+    if progress:
+        progress.record_session(session_tally.result())
+        progress.close()
+
+    if midi_thread:
+        midi_thread.stop()
+    pg.midi.quit()
+
+    pg.quit()
 
-        pg.display.flip()
-        pg.display.update()
-        fpsClock.tick(FPS)
-# end main game loop
 
-del midi_in
-pg.midi.quit()
-
-pg.quit()
-sys.exit()
+if __name__ == '__main__':
+    import main
+    main.run()
+    sys.exit()
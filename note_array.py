@@ -0,0 +1,264 @@
+from collections.abc import Mapping
+
+import numpy as np
+
+import main
+from main import NoteCollisionSideEffect
+
+NO_SIDE_EFFECT = -1
+
+
+# Struct-of-arrays storage for one kind of note. Rows are kept in registration order, so "first registered" is
+# always the lowest row, same as iterating the OrderedDicts in GameState.
+class NoteArrayStore:
+    INITIAL_CAPACITY = 256
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self.size = 0
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.x_position = np.zeros(capacity, dtype=np.float64)
+        self.speed = np.zeros(capacity, dtype=np.float64)
+        self.x_thresh = np.zeros(capacity, dtype=np.float64)
+        self.height = np.zeros(capacity, dtype=np.int16)
+        self.side_effect = np.full(capacity, NO_SIDE_EFFECT, dtype=np.int8)
+        self.is_first = np.zeros(capacity, dtype=bool)
+
+    FIELDS = ["ids", "x_position", "speed", "x_thresh", "height", "side_effect", "is_first"]
+
+    def _grow(self, needed):
+        capacity = len(self.ids)
+        while capacity < needed:
+            capacity *= 2
+        for field in self.FIELDS:
+            old = getattr(self, field)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, field, new)
+
+    def append(self, ids, x_position, speed, x_thresh, height):
+        n = len(ids)
+        if self.size + n > len(self.ids):
+            self._grow(self.size + n)
+        rows = slice(self.size, self.size + n)
+        self.ids[rows] = ids
+        self.x_position[rows] = x_position
+        self.speed[rows] = speed
+        self.x_thresh[rows] = x_thresh
+        self.height[rows] = height
+        self.side_effect[rows] = NO_SIDE_EFFECT
+        self.is_first[rows] = False
+        self.size += n
+
+    def compact(self, keep):
+        n = int(np.count_nonzero(keep))
+        for field in self.FIELDS:
+            arr = getattr(self, field)
+            arr[:n] = arr[:self.size][keep]
+        self.size = n
+
+    def row_of(self, id):
+        rows = np.flatnonzero(self.ids[:self.size] == id)
+        if not len(rows):
+            raise KeyError(id)
+        return int(rows[0])
+
+
+# Thin Note views over a row of a NoteArrayStore, so the arrays can be drawn with the regular Note.draw
+class ArrayNoteView(main.Note):
+    def __init__(self, store, row, staff_note_height_ids):
+        self.store = store
+        self.row = row
+        self.staff_note_height_ids = staff_note_height_ids
+
+    @property
+    def x_position(self):
+        return self.store.x_position[self.row]
+
+    @property
+    def note_height_id(self):
+        return self.staff_note_height_ids[self.store.height[self.row]]
+
+    @property
+    def side_effect(self):
+        side_effect = self.store.side_effect[self.row]
+        return None if side_effect == NO_SIDE_EFFECT else NoteCollisionSideEffect(int(side_effect))
+
+    @property
+    def should_destroy(self):
+        return self.side_effect
+
+    @property
+    def note_real_value(self):
+        return self.note_height_id
+
+    def update(self):
+        pass
+
+
+class PlayerShotView(ArrayNoteView):
+    note_color = main.PLAYER_NOTE_COLOR
+
+
+class EnemyNoteView(ArrayNoteView):
+    @property
+    def is_first(self):
+        return bool(self.store.is_first[self.row])
+
+    @property
+    def note_color(self):
+        return main.FIRST_ENEMY_NOTE_COLOR if self.is_first else main.ENEMY_NOTE_COLOR
+
+
+# Read-only id -> view mapping, standing in for GameState.player_notes / enemy_notes
+class NoteArrayMapping(Mapping):
+    def __init__(self, store, view_class, note_height_ids):
+        self.store = store
+        self.view_class = view_class
+        self.note_height_ids = note_height_ids
+
+    def __len__(self):
+        return self.store.size
+
+    def __iter__(self):
+        return iter(self.store.ids[:self.store.size].tolist())
+
+    def __getitem__(self, id):
+        return self.view_class(self.store, self.store.row_of(id), self.note_height_ids)
+
+    def items(self):
+        return ((int(self.store.ids[row]), self.view_class(self.store, row, self.note_height_ids))
+                for row in range(self.store.size))
+
+
+# GameState with notes kept in NumPy arrays instead of one Python object each. Movement and threshold checks are
+# whole-array operations, and collision matching only falls back to Python for the pairs that actually collide; they
+# replace the per-note phases of GameState.update, with the same results.
+class ArrayGameState(main.GameState):
+    def __init__(self, staff, lesson):
+        if isinstance(lesson, main.SongLesson):
+            raise ValueError("the arrays backend doesn't support songs")
+        if lesson.has_chords:
+            raise ValueError("the arrays backend stores one pitch per note and can't play chord lessons")
+        super().__init__(staff, lesson)
+        self.note_height_ids = staff.note_height_ids
+        self.height_index = {note_height_id: i for (i, note_height_id) in enumerate(self.note_height_ids)}
+        self.enemy_store = NoteArrayStore()
+        self.player_store = NoteArrayStore()
+        self.enemy_notes = NoteArrayMapping(self.enemy_store, EnemyNoteView, self.note_height_ids)
+        self.player_notes = NoteArrayMapping(self.player_store, PlayerShotView, self.note_height_ids)
+
+    def move_notes(self):
+        shots, enemies = self.player_store, self.enemy_store
+        n = shots.size
+        shots.x_position[:n] += shots.speed[:n]
+        shots.side_effect[:n][shots.x_position[:n] > shots.x_thresh[:n]] = \
+            NoteCollisionSideEffect.PLAYER_MISSED_ALL.value
+
+        n = enemies.size
+        enemies.x_position[:n] += enemies.speed[:n]
+        enemies.side_effect[:n][enemies.x_position[:n] < enemies.x_thresh[:n]] = \
+            NoteCollisionSideEffect.ENEMY_NOTE_GOT_THROUGH.value
+        if n:
+            enemies.is_first[0] = True
+
+    # Same matching as NoteCollisionIndex: each shot, in registration order, hits the earliest registered free enemy on
+    # its line that is to the left of it. Live enemies are sorted once by (height, x) with exact integer keys (x is
+    # replaced by its rank among all x positions in play), so the enemies a shot can reach are the sorted positions
+    # [start, end) found with searchsorted, and frames where no shot reaches an enemy end there. Otherwise, per height
+    # and in registration order, each reachable enemy goes to the earliest registered shot not matched yet that
+    # reaches it, which gives the same pairs as matching shot by shot. When every shot on a line reaches every enemy
+    # on it (the usual case, shots move in lockstep) that is a straight pairing; only other lines are walked in Python.
+    def resolve_collisions(self):
+        shots, enemies = self.player_store, self.enemy_store
+        shot_rows = np.flatnonzero(shots.side_effect[:shots.size] == NO_SIDE_EFFECT)
+        enemy_rows = np.flatnonzero(enemies.side_effect[:enemies.size] == NO_SIDE_EFFECT)
+        if not len(shot_rows) or not len(enemy_rows):
+            return
+        (xs, x_ranks) = np.unique(np.concatenate((enemies.x_position[enemy_rows], shots.x_position[shot_rows])),
+                                  return_inverse=True)
+        stride = len(xs) + 1
+        enemy_keys = enemies.height[enemy_rows].astype(np.int64) * stride + x_ranks[:len(enemy_rows)]
+        order = np.argsort(enemy_keys, kind="stable")
+        sorted_keys = enemy_keys[order]
+        shot_lines = shots.height[shot_rows].astype(np.int64) * stride
+        starts = np.searchsorted(sorted_keys, shot_lines)
+        ends = np.searchsorted(sorted_keys, shot_lines + x_ranks[len(enemy_rows):])
+        reaching = np.flatnonzero(ends > starts)
+        if not len(reaching):
+            return
+
+        # sorted positions some shot reaches, as enemy rows grouped by height in registration order
+        coverage = np.zeros(len(sorted_keys) + 1, dtype=np.int64)
+        np.add.at(coverage, starts[reaching], 1)
+        np.add.at(coverage, ends[reaching], -1)
+        reached = np.flatnonzero(np.cumsum(coverage[:-1]) > 0)
+        reached_rows = enemy_rows[order[reached]]
+        reached_heights = enemies.height[reached_rows]
+        by_line = np.lexsort((reached_rows, reached_heights))
+        (lines, line_starts) = np.unique(reached_heights[by_line], return_index=True)
+
+        shot_heights = shots.height[shot_rows[reaching]]
+        (hit_enemies, hit_shots) = ([], [])
+        for (line, line_enemies) in zip(lines, np.split(by_line, line_starts[1:])):
+            line_shots = reaching[shot_heights == line]
+            line_ends = ends[line_shots]
+            if line_ends.min() > reached[line_enemies].max():
+                # every shot on the line reaches every enemy on it: they pair off in registration order
+                n = min(len(line_enemies), len(line_shots))
+                hit_enemies.append(reached_rows[line_enemies[:n]])
+                hit_shots.append(shot_rows[line_shots[:n]])
+                continue
+            matched = np.zeros(len(line_shots), dtype=bool)
+            for i in line_enemies.tolist():
+                candidates = np.flatnonzero(~matched & (line_ends > reached[i]))
+                if len(candidates):
+                    matched[candidates[0]] = True
+                    hit_enemies.append(reached_rows[i:i + 1])
+                    hit_shots.append(shot_rows[line_shots[candidates[0]:candidates[0] + 1]])
+        if not hit_enemies:
+            return
+
+        hit_enemies = np.concatenate(hit_enemies)
+        hit_shots = np.concatenate(hit_shots)
+        first = enemies.is_first[hit_enemies]
+        enemies.side_effect[hit_enemies] = np.where(first, NoteCollisionSideEffect.SUCCESSFUL_COLLISION_ENEMY.value,
+                                                    NoteCollisionSideEffect.COLLISION_NOT_FIRST_NOTE.value)
+        shots.side_effect[hit_shots] = np.where(first, NoteCollisionSideEffect.SUCCESSFUL_COLLISION_PLAYER.value,
+                                                NoteCollisionSideEffect.NONE.value)
+
+    def destroy_notes(self):
+        side_effects = []
+        for store in (self.player_store, self.enemy_store):
+            effects = store.side_effect[:store.size]
+            destroyed = effects != NO_SIDE_EFFECT
+            if destroyed.any():
+                side_effects.extend(zip(effects[destroyed].tolist(), store.height[:store.size][destroyed].tolist()))
+                store.compact(~destroyed)
+
+        for (side_effect, height) in side_effects:
+            self.do_side_effect(NoteCollisionSideEffect(side_effect), self.note_height_ids[height])
+
+    def shoot(self, pitch, velocity, frame_offset):
+        x_init = self.staff.CLEF_PLAY_AREA_POS[0] + main.PlayerShot.PLAYER_SHOT_SPEED * frame_offset
+        self.player_store.append([self.latest_note_id], x_init, main.PlayerShot.PLAYER_SHOT_SPEED,
+                                 self.staff.STAFF_TOP_RIGHT_CORNER[0], pitch.height)
+        self.latest_note_id += 1
+
+    def register_player_note(self, note):
+        self.player_store.append([self.latest_note_id], note.x_position, note.PLAYER_SHOT_SPEED, note.x_thresh,
+                                 self.height_index[note.note_height_id])
+        self.latest_note_id += 1
+
+    # the note's fields are copied into the arrays, so the object itself goes straight back to the pool
+    def register_enemy_note(self, note):
+        self.enemy_store.append([self.latest_note_id], note.x_position, note.ENEMY_NOTE_SPEED, note.x_thresh,
+                                self.height_index[note.note_height_id])
+        self.latest_note_id += 1
+        self.note_pool.release(note)
+
+    def register_enemy_notes(self, x_positions, note_height_ids, speed, x_thresh):
+        n = len(x_positions)
+        ids = np.arange(self.latest_note_id, self.latest_note_id + n)
+        heights = [self.height_index[note_height_id] for note_height_id in note_height_ids]
+        self.enemy_store.append(ids, x_positions, speed, x_thresh, heights)
+        self.latest_note_id += n
@@ -0,0 +1,124 @@
+import csv
+import json
+import time
+
+from collections import deque, OrderedDict
+
+PERCENTILES = [50, 95, 99]
+
+
+def percentile(sorted_samples, pct):
+    if not sorted_samples:
+        return 0.0
+    rank = max(int(round(pct / 100 * len(sorted_samples))) - 1, 0)
+    return sorted_samples[rank]
+
+
+# Opt-in per-frame timing of named sections of the frame loop. Time spent between begin(name) and end(name) is
+# summed per frame and begin_frame() to end_frame() is recorded as "frame". end_frame() pushes the frame's totals
+# into a bounded history that the percentiles, the overlay and dump() are computed from.
+class FrameProfiler:
+    enabled = True
+    HISTORY_FRAMES = 3600
+    OVERLAY_REFRESH_FRAMES = 15
+
+    def __init__(self, history_frames=HISTORY_FRAMES):
+        self.history_frames = history_frames
+        self.samples = OrderedDict()
+        self.starts = {}
+        self.frame = {}
+        self.frame_start = time.perf_counter()
+        self.frames = 0
+        self.overlay_lines = []
+
+    def begin_frame(self):
+        self.frame_start = time.perf_counter()
+
+    def begin(self, name):
+        self.starts[name] = time.perf_counter()
+
+    def end(self, name):
+        self.frame[name] = self.frame.get(name, 0.0) + time.perf_counter() - self.starts[name]
+
+    # adds time measured elsewhere, e.g. on another thread, to this frame's total for name
+    def record(self, name, seconds):
+        self.frame[name] = self.frame.get(name, 0.0) + seconds
+
+    def end_frame(self):
+        self.frame["frame"] = time.perf_counter() - self.frame_start
+        for name in self.samples:
+            if name not in self.frame:
+                self.samples[name].append(0.0)
+        for (name, seconds) in self.frame.items():
+            history = self.samples.get(name)
+            if history is None:
+                history = self.samples[name] = deque([0.0] * min(self.frames, self.history_frames),
+                                                     maxlen=self.history_frames)
+            history.append(seconds)
+        self.frame.clear()
+        self.frames += 1
+
+    def percentiles(self, name):
+        samples = sorted(self.samples.get(name, []))
+        return [percentile(samples, pct) for pct in PERCENTILES]
+
+    def summary(self):
+        res = OrderedDict()
+        for (name, history) in self.samples.items():
+            row = OrderedDict((f"p{pct}_ms", value * 1000) for (pct, value) in zip(PERCENTILES,
+                                                                                 self.percentiles(name)))
+            row["max_ms"] = max(history, default=0.0) * 1000
+            res[name] = row
+        return res
+
+    # .csv gets one row per recorded frame, anything else a JSON summary of the percentiles
+    def dump(self, fname):
+        if fname.endswith(".csv"):
+            names = list(self.samples)
+            with open(fname, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["frame"] + [f"{name}_ms" for name in names])
+                frames = max((len(history) for history in self.samples.values()), default=0)
+                first_frame = self.frames - frames
+                for i in range(frames):
+                    writer.writerow([first_frame + i] + [f"{self.samples[name][i] * 1000:.4f}" for name in names])
+        else:
+            with open(fname, "w") as f:
+                json.dump({"frames": self.frames, "sections": self.summary()}, f, indent=2)
+
+    def draw_overlay(self, surf, text_renderer, pos, color=(0, 0, 0)):
+        if not self.overlay_lines or self.frames % self.OVERLAY_REFRESH_FRAMES == 0:
+            self.overlay_lines = [f"{'section':<20}{'p50':>7}{'p95':>7}{'p99':>7}"]
+            for name in self.samples:
+                p50, p95, p99 = self.percentiles(name)
+                self.overlay_lines.append(f"{name:<20}{p50 * 1000:7.2f}{p95 * 1000:7.2f}{p99 * 1000:7.2f}")
+        rects = []
+        (x, y) = pos
+        for line in self.overlay_lines:
+            rect = text_renderer.draw(surf, line, color, (x, y))
+            rects.append(rect)
+            y += rect.height
+        return rects[0].unionall(rects[1:])
+
+
+# Stands in for FrameProfiler when profiling is off
+class NullProfiler:
+    enabled = False
+
+    def begin_frame(self):
+        pass
+
+    def begin(self, name):
+        pass
+
+    def end(self, name):
+        pass
+
+    def record(self, name, seconds):
+        pass
+
+    def end_frame(self):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
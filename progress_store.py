@@ -0,0 +1,216 @@
+import argparse
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from collections import Counter, namedtuple
+
+# Must be set before pygame is imported by main
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import main
+from main import ERROR_SIDE_EFFECTS, NoteCollisionSideEffect
+
+DEFAULT_DB = os.path.join(main.main_dir, "progress.sqlite3")
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Sessions and their per-note results, keyed by student. Every query a report needs is a range scan over one of the
+# indexes (the note index covers the counts, so it never touches the table), and lesson_totals keeps running totals
+# so all-time lesson rankings don't have to scan years of sessions.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    student TEXT NOT NULL,
+    lesson TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    frames INTEGER NOT NULL,
+    score INTEGER NOT NULL,
+    hits INTEGER NOT NULL,
+    errors INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_by_student ON sessions (student, started_at, lesson, hits, errors);
+CREATE INDEX IF NOT EXISTS sessions_by_time ON sessions (started_at, lesson, hits, errors);
+
+CREATE TABLE IF NOT EXISTS session_notes (
+    session_id INTEGER NOT NULL REFERENCES sessions (id),
+    student TEXT NOT NULL,
+    note_height_id TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    hits INTEGER NOT NULL,
+    errors INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS session_notes_by_student
+    ON session_notes (student, note_height_id, started_at, hits, errors);
+
+CREATE TABLE IF NOT EXISTS lesson_totals (
+    student TEXT NOT NULL,
+    lesson TEXT NOT NULL,
+    sessions INTEGER NOT NULL,
+    hits INTEGER NOT NULL,
+    errors INTEGER NOT NULL,
+    PRIMARY KEY (student, lesson)
+);
+"""
+
+SessionResult = namedtuple("SessionResult", ["student", "lesson", "started_at", "frames", "score", "note_hits",
+                                             "note_errors"])
+NoteAccuracy = namedtuple("NoteAccuracy", ["note", "hits", "errors", "accuracy"])
+LessonErrorRate = namedtuple("LessonErrorRate", ["lesson", "sessions", "hits", "errors", "error_rate"])
+
+
+# Bus subscriber counting a session's hits and errors per note height, to be stored when the session ends
+class SessionTally:
+    def __init__(self, gamestate, student):
+        self.gamestate = gamestate
+        self.student = student
+        self.started_at = time.time()
+        self.note_hits = Counter()
+        self.note_errors = Counter()
+        gamestate.bus.subscribe(main.TOPIC_SIDE_EFFECT, self.record_side_effect)
+
+    def record_side_effect(self, event):
+        side_effect = event.payload.side_effect
+        if side_effect == NoteCollisionSideEffect.SUCCESSFUL_COLLISION_ENEMY:
+            self.note_hits[event.payload.note_height_id] += 1
+        elif side_effect in ERROR_SIDE_EFFECTS:
+            self.note_errors[event.payload.note_height_id] += 1
+
+    def result(self):
+        gamestate = self.gamestate
+        return SessionResult(self.student, gamestate.lesson.name, self.started_at, gamestate.frame_num,
+                             gamestate.score, self.note_hits, self.note_errors)
+
+
+# "F4" means F4 on either clef, "F4_TREBLE" just the one
+def note_height_ids_for(note):
+    if "_" in note:
+        return [note]
+    return [f"{note}_{clef}" for clef in main.CLEFS]
+
+
+# Results are written by a background thread, a batch per transaction, so record_session only costs the frame loop a
+# queue put. Queries run on the caller's own connection; the database is in WAL mode, so they don't wait on writes.
+class ProgressStore:
+    FLUSH_INTERVAL = 0.5
+
+    def __init__(self, path=DEFAULT_DB, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.db = self.connect()
+        self.db.executescript(SCHEMA)
+        self.pending = queue.Queue()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def record_session(self, result):
+        self.pending.put(result)
+
+    def run(self):
+        db = self.connect()
+        while self.running or not self.pending.empty():
+            try:
+                batch = [self.pending.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while True:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            with db:
+                for result in batch:
+                    self.write_session(db, result)
+        db.close()
+
+    def write_session(self, db, result):
+        hits = sum(result.note_hits.values())
+        errors = sum(result.note_errors.values())
+        cursor = db.execute("INSERT INTO sessions (student, lesson, started_at, frames, score, hits, errors) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (result.student, result.lesson, result.started_at, result.frames, result.score, hits,
+                             errors))
+        db.executemany("INSERT INTO session_notes (session_id, student, note_height_id, started_at, hits, errors) "
+                       "VALUES (?, ?, ?, ?, ?, ?)",
+                       [(cursor.lastrowid, result.student, note_height_id, result.started_at,
+                         result.note_hits[note_height_id], result.note_errors[note_height_id])
+                        for note_height_id in sorted(set(result.note_hits) | set(result.note_errors))])
+        db.execute("INSERT INTO lesson_totals (student, lesson, sessions, hits, errors) VALUES (?, ?, 1, ?, ?) "
+                   "ON CONFLICT (student, lesson) DO UPDATE SET sessions = sessions + 1, hits = hits + excluded.hits, "
+                   "errors = errors + excluded.errors",
+                   (result.student, result.lesson, hits, errors))
+
+    # waits for everything recorded so far to be written
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.db.close()
+
+    def since(self, days, now=None):
+        return (now or time.time()) - days * SECONDS_PER_DAY
+
+    def note_accuracy(self, student, note, days=None, now=None):
+        note_height_ids = note_height_ids_for(note)
+        query = (f"SELECT SUM(hits), SUM(errors) FROM session_notes WHERE student = ? "
+                 f"AND note_height_id IN ({', '.join('?' * len(note_height_ids))})")
+        params = [student] + note_height_ids
+        if days is not None:
+            query += " AND started_at >= ?"
+            params.append(self.since(days, now))
+        (hits, errors) = self.db.execute(query, params).fetchone()
+        (hits, errors) = (hits or 0, errors or 0)
+        return NoteAccuracy(note, hits, errors, hits / (hits + errors) if hits + errors else None)
+
+    # worst first; for one student or, with student None, the whole school
+    def lessons_by_error_rate(self, student=None, days=None, now=None):
+        if days is None:
+            (table, sessions, conditions, params) = ("lesson_totals", "SUM(sessions)", [], [])
+        else:
+            (table, sessions, conditions, params) = ("sessions", "COUNT(*)", ["started_at >= ?"],
+                                                     [self.since(days, now)])
+        if student is not None:
+            conditions.append("student = ?")
+            params.append(student)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self.db.execute(f"SELECT lesson, {sessions}, SUM(hits), SUM(errors) FROM {table} {where} "
+                               f"GROUP BY lesson", params).fetchall()
+        res = [LessonErrorRate(lesson, sessions, hits, errors, errors / (hits + errors) if hits + errors else 0.0)
+               for (lesson, sessions, hits, errors) in rows]
+        return sorted(res, key=lambda lesson: -lesson.error_rate)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Query the progress recorded with main.py --student")
+    parser.add_argument("--db", default=DEFAULT_DB, help="progress database")
+    parser.add_argument("--student", help="only this student's sessions (default: everyone, for --lessons)")
+    parser.add_argument("--note", action="append", default=[],
+                        help="report accuracy on this note, e.g. F4 or F4_TREBLE (needs --student)")
+    parser.add_argument("--lessons", action="store_true", help="list lessons by error rate")
+    parser.add_argument("--days", type=float, help="only the last DAYS days (default: all time)")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    store = ProgressStore(args.db)
+    if args.note and not args.student:
+        raise SystemExit("--note needs --student")
+    for note in args.note:
+        accuracy = store.note_accuracy(args.student, note, args.days)
+        if accuracy.accuracy is None:
+            print(f"{note:<12}no attempts")
+        else:
+            print(f"{note:<12}{accuracy.accuracy:7.1%}  ({accuracy.hits}/{accuracy.hits + accuracy.errors})")
+    if args.lessons:
+        for lesson in store.lessons_by_error_rate(args.student, args.days):
+            print(f"{lesson.lesson:<16}{lesson.error_rate:7.1%}  ({lesson.errors} errors, {lesson.hits} hits, "
+                  f"{lesson.sessions} sessions)")
+    store.close()
@@ -0,0 +1,145 @@
+import argparse
+import os
+import struct
+
+from array import array
+from collections import namedtuple
+
+# Must be set before pygame is imported by main
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import main
+
+# Session log layout, little-endian:
+#   header: magic, format version, lesson RNG seed, lesson name length, flags (u8, version 2 on), lesson name (utf-8)
+#   records: a tag byte followed by
+#     NOTE_RECORD: frame the note landed on (u32), MIDI note, velocity, quantised frame offset (u8 each)
+#     END_RECORD:  number of frames the session ran for (u32)
+SESSION_SUFFIX = ".mlsr"
+MAGIC = b"MLSR"
+FORMAT_VERSION = 2
+HEADERS = {1: struct.Struct("<4sBQH"), 2: struct.Struct("<4sBQHB")}
+HEADER = HEADERS[FORMAT_VERSION]
+FLAG_ADAPTIVE_SPAWNS = 1
+NOTE_RECORD = b"N"
+NOTE = struct.Struct("<IBBB")
+END_RECORD = b"E"
+END = struct.Struct("<I")
+
+# When a log has no end record (the game crashed), replay this long past the last note to let shots land
+DRAIN_FRAMES = 300
+
+RecordedNote = namedtuple("RecordedNote", ["frame", "midi_note", "velocity", "frame_offset"])
+Session = namedtuple("Session", ["seed", "lesson_name", "notes", "frames", "adaptive"])
+SideEffectEvent = namedtuple("SideEffectEvent", ["frame", "side_effect", "note_height_id"])
+ReplayResult = namedtuple("ReplayResult", ["lesson_name", "seed", "frames", "score", "pain_timeline",
+                                           "side_effects"])
+
+
+class SessionLogError(ValueError):
+    pass
+
+
+# Attached to GameState.input_recorder; appends every note passed to GameState.send_midi_note to the log
+class SessionRecorder:
+    def __init__(self, fname, seed, lesson_name, adaptive=False):
+        self.f = open(fname, "wb")
+        name = lesson_name.encode()
+        flags = FLAG_ADAPTIVE_SPAWNS if adaptive else 0
+        self.f.write(HEADER.pack(MAGIC, FORMAT_VERSION, seed, len(name), flags))
+        self.f.write(name)
+
+    def record_note(self, frame, midi_note, velocity, frame_offset):
+        self.f.write(NOTE_RECORD)
+        self.f.write(NOTE.pack(frame, midi_note, velocity, round(frame_offset * main.FRAME_OFFSET_STEPS)))
+
+    def close(self, frames):
+        self.f.write(END_RECORD)
+        self.f.write(END.pack(frames))
+        self.f.close()
+
+
+def read_session(fname):
+    with open(fname, "rb") as f:
+        data = f.read()
+    if len(data) < 5 or data[:4] != MAGIC or data[4] not in HEADERS:
+        raise SessionLogError(f"{fname}: not a session log, or from a newer version")
+    header = HEADERS[data[4]]
+    if len(data) < header.size:
+        raise SessionLogError(f"{fname}: truncated header")
+    (magic, version, seed, name_len, *flags) = header.unpack_from(data)
+    adaptive = bool(flags and flags[0] & FLAG_ADAPTIVE_SPAWNS)
+    pos = header.size
+    lesson_name = data[pos:pos + name_len].decode()
+    pos += name_len
+
+    notes = []
+    frames = None
+    while pos < len(data):
+        tag = data[pos:pos + 1]
+        pos += 1
+        if tag == NOTE_RECORD and pos + NOTE.size <= len(data):
+            (frame, midi_note, velocity, offset) = NOTE.unpack_from(data, pos)
+            notes.append(RecordedNote(frame, midi_note, velocity, offset / main.FRAME_OFFSET_STEPS))
+            pos += NOTE.size
+        elif tag == END_RECORD and pos + END.size <= len(data):
+            (frames,) = END.unpack_from(data, pos)
+            pos += END.size
+        else:
+            break  # torn write at the end of a crashed session; keep what we have
+    if frames is None:
+        frames = (notes[-1].frame if notes else 0) + DRAIN_FRAMES
+    return Session(seed, lesson_name, notes, frames, adaptive)
+
+
+class ReplayGameState(main.GameState):
+    def __init__(self, staff, lesson):
+        super().__init__(staff, lesson)
+        self.side_effect_events = []
+        self.bus.subscribe(main.TOPIC_SIDE_EFFECT, self.record_side_effect)
+
+    def record_side_effect(self, event):
+        self.side_effect_events.append(SideEffectEvent(event.frame, event.payload.side_effect,
+                                                       event.payload.note_height_id))
+
+
+# Re-runs a recorded session through GameState.update with no rendering, as fast as possible
+def replay_session(session, staff=None, registry=None):
+    staff = staff or main.Staff()
+    lesson = main.load_lesson(staff, session.lesson_name, registry=registry, seed=session.seed)
+    gamestate = ReplayGameState(staff, lesson)
+    if session.adaptive:
+        gamestate.spawn_scheduler = main.AdaptiveSpawnScheduler(gamestate)
+    pain_timeline = array('B')
+
+    notes = iter(session.notes)
+    note = next(notes, None)
+    for _ in range(session.frames):
+        while note and note.frame <= gamestate.frame_num:
+            gamestate.send_midi_note(note.midi_note, note.velocity, note.frame_offset)
+            note = next(notes, None)
+        gamestate.update()
+        pain_timeline.append(max(gamestate.pain, 0))
+
+    return ReplayResult(session.lesson_name, session.seed, session.frames, gamestate.score, pain_timeline,
+                        gamestate.side_effect_events)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay a recorded session without rendering")
+    parser.add_argument("session", help="session log written with --record")
+    parser.add_argument("--side-effects", action="store_true", help="list every side effect")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    result = replay_session(read_session(args.session))
+    print(f"lesson: {result.lesson_name} seed: {result.seed} frames: {result.frames}")
+    print(f"score: {result.score}")
+    print(f"peak pain: {max(result.pain_timeline, default=0)}, "
+          f"frames in pain: {sum(1 for pain in result.pain_timeline if pain)}")
+    if args.side_effects:
+        for event in result.side_effects:
+            print(f"{event.frame}\t{event.side_effect.name}\t{event.note_height_id}")
@@ -0,0 +1,250 @@
+import argparse
+import math
+import os
+import random
+import sys
+
+import pygame as pg
+
+import main
+
+LABEL_FONT_SIZE = 14
+LABEL_COLOR = (0, 0, 0)
+SCREENSHOT_FORMAT = "session_{}.png"
+RECORDING_FORMAT = "session_{}.mlsr"
+
+
+# columns x rows for count tiles, as close to square as possible
+def tile_grid(count):
+    columns = math.ceil(math.sqrt(count))
+    return (columns, math.ceil(count / columns))
+
+
+# Draws one session into its tile of the shared window. Presenting is left to the host, which pushes every tile's
+# changed regions, moved to where the tile sits in the window, in one pg.display.update per frame.
+class TileRenderer(main.DirtyRectRenderer):
+    def __init__(self, tile, background, staff):
+        super().__init__(tile, background, staff=staff)
+        self.offset = tile.get_abs_offset()
+        self.dirty = []
+
+    def present(self, rects):
+        self.dirty.extend(rect.move(self.offset) for rect in rects)
+
+    def take_dirty(self):
+        (dirty, self.dirty) = (self.dirty, [])
+        return dirty
+
+
+# One student's game: its own GameState, lesson RNG and input (a MIDI device, a stand-in player or nothing)
+class HostedSession:
+    def __init__(self, gamestate, renderer, label, midi_thread=None, player_input=None):
+        self.gamestate = gamestate
+        self.renderer = renderer
+        self.label = label
+        self.midi_thread = midi_thread
+        self.player_input = player_input
+
+
+# Runs several sessions in one process, stepped together by one fixed timestep. What the sessions only read is
+# loaded once and shared: the simulation staff and the lesson registry's compiled lessons, and the screen staff,
+# laid out once for the tile size so its background and note sprites are rendered once. Images and fonts are already
+# cached per process by main.
+class SessionHost:
+    def __init__(self, tile_size):
+        self.staff = main.Staff()
+        self.registry = main.new_lesson_registry(self.staff)
+        self.screen_staff = main.Staff(main.StaffLayout(tile_size))
+        self.background = self.screen_staff.get_surface(tile_size)
+        self.label_text = main.TextRenderer('Times New Roman', LABEL_FONT_SIZE)
+        self.label_pos = (self.screen_staff.STAFF_POS[0] + 5, self.screen_staff.STAFF_POS[1] + 5)
+        self.sessions = []
+
+    def add_session(self, surface, lesson_name, seed=None, label=None, midi_thread=None, player_input=None):
+        lesson = main.load_lesson(self.staff, lesson_name, registry=self.registry, seed=seed)
+        gamestate = main.GameState(self.staff, lesson)
+        renderer = TileRenderer(surface, self.background, self.screen_staff)
+        if label:
+            renderer.overlays.append(lambda surf: self.label_text.draw(surf, label, LABEL_COLOR, self.label_pos))
+        session = HostedSession(gamestate, renderer, label, midi_thread, player_input)
+        self.sessions.append(session)
+        return session
+
+    # notes played since the last call; dropped while paused, like main.py does
+    def handle_midi(self, paused=False):
+        midi_now = pg.midi.time() if any(session.midi_thread for session in self.sessions) else 0
+        for session in self.sessions:
+            if not session.midi_thread:
+                continue
+            for midi_event in session.midi_thread.drain():
+                if not paused:
+                    session.gamestate.send_midi_note(midi_event.data1, midi_event.data2,
+                                                     main.midi_frame_offset(midi_event.timestamp, midi_now))
+
+    def update(self):
+        for session in self.sessions:
+            gamestate = session.gamestate
+            if session.player_input:
+                for midi_note in session.player_input.notes_for_frame(gamestate):
+                    gamestate.send_midi_note(midi_note)
+            gamestate.update()
+
+    # draws every session; returns the window regions that changed
+    def render(self):
+        dirty = []
+        for session in self.sessions:
+            session.renderer.render(session.gamestate)
+            dirty.extend(session.renderer.take_dirty())
+        return dirty
+
+    def invalidate(self):
+        for session in self.sessions:
+            session.renderer.invalidate()
+
+
+# MIDI input device ids, in portmidi's order
+def midi_input_devices():
+    return [device_id for device_id in range(pg.midi.get_count()) if pg.midi.get_device_info(device_id)[2]]
+
+
+def open_midi_input(device_id):
+    midi_thread = main.MidiInputThread(pg.midi.Input(device_id))
+    midi_thread.start()
+    return midi_thread
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run one session per MIDI keyboard, all in one process and window")
+    parser.add_argument("--devices", type=int, nargs="*",
+                        help="MIDI input device ids, one session each (default: every input device)")
+    parser.add_argument("--sessions", type=int,
+                        help="number of sessions (default: one per device); sessions without a device get no input "
+                             "unless --autoplay is given")
+    parser.add_argument("--lesson", action="append", default=[],
+                        help="lesson name or number, or song file; repeat to give each session its own (cycled)")
+    parser.add_argument("--seed", type=int, help="seed of the first session's lesson, the next get seed + 1, ... "
+                                                 "(random by default)")
+    parser.add_argument("--student", action="append", default=[],
+                        help="save session results to the progress database under this name; repeat per session")
+    parser.add_argument("--progress-db", metavar="FILE", help="progress database (default: progress.sqlite3)")
+    parser.add_argument("--record-dir", metavar="DIR", help="record every session for replay.py into DIR")
+    parser.add_argument("--autoplay", type=float, metavar="ACCURACY",
+                        help="play sessions that have no MIDI device with headless.py's autoplayer")
+    parser.add_argument("--size", type=main.parse_size, default=(2 * main.SCREEN_WIDTH, 2 * main.SCREEN_HEIGHT),
+                        metavar="WIDTHxHEIGHT", help="window size, split into one tile per session")
+    parser.add_argument("--headless", action="store_true",
+                        help="draw each session onto its own offscreen surface of the tile size instead of a window")
+    parser.add_argument("--frames", type=int, help="run this many frames as fast as possible, then quit")
+    parser.add_argument("--screenshot-dir", metavar="DIR", help="save each session's last frame into DIR on exit")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.headless:
+        # read by SDL when the display is initialised
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+    pg.midi.init()
+    devices = midi_input_devices() if args.devices is None else args.devices
+    count = args.sessions if args.sessions is not None else len(devices)
+    if count < 1:
+        sys.exit("no sessions: no MIDI input devices found, use --sessions")
+    (columns, rows) = tile_grid(count)
+    tile_size = (args.size[0] // columns, args.size[1] // rows)
+
+    screen = main.init_display(tile_size if args.headless else args.size)
+    pg.display.set_caption(f"{count} sessions")
+    if args.headless:
+        surfaces = [pg.Surface(tile_size).convert() for _ in range(count)]
+    else:
+        surfaces = [screen.subsurface(pg.Rect(((i % columns) * tile_size[0], (i // columns) * tile_size[1]),
+                                              tile_size))
+                    for i in range(count)]
+
+    host = SessionHost(tile_size)
+    lessons = args.lesson or ["lesson_4"]
+    progress = None
+    if args.student:
+        from progress_store import DEFAULT_DB, ProgressStore, SessionTally
+        progress = ProgressStore(args.progress_db or DEFAULT_DB)
+    if args.autoplay is not None:
+        import headless
+    if args.record_dir:
+        from replay import SessionRecorder
+        os.makedirs(args.record_dir, exist_ok=True)
+    tallies = []
+
+    for i in range(count):
+        midi_thread = None
+        player_input = None
+        if i < len(devices):
+            midi_thread = open_midi_input(devices[i])
+            label = pg.midi.get_device_info(devices[i])[1].decode(errors="replace")
+        else:
+            label = f"session {i + 1}"
+        if i < len(args.student):
+            label = args.student[i]
+        seed = None if args.seed is None else args.seed + i
+        if midi_thread is None and args.autoplay is not None:
+            player_input = headless.AutoPlayer(args.autoplay, rng=random.Random(seed))
+        session = host.add_session(surfaces[i], lessons[i % len(lessons)], seed, label, midi_thread, player_input)
+        gamestate = session.gamestate
+        if i < len(args.student):
+            tallies.append(SessionTally(gamestate, args.student[i]))
+        if args.record_dir:
+            gamestate.input_recorder = SessionRecorder(os.path.join(args.record_dir, RECORDING_FORMAT.format(i + 1)),
+                                                       gamestate.lesson.seed, gamestate.lesson.name)
+
+    timestep = main.FixedTimestep()
+    main.fpsClock.tick()
+    paused = False
+    frames = 0
+    going = True
+    while going:
+        for event in pg.event.get():
+            if event.type == pg.QUIT:
+                going = False
+            elif event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE:
+                paused = not paused
+            elif event.type == pg.VIDEOEXPOSE:
+                host.invalidate()
+
+        host.handle_midi(paused)
+        if args.frames is not None:
+            steps = 1  # as fast as possible
+        else:
+            steps = timestep.advance(main.fpsClock.get_time())
+        if paused:
+            steps = 0
+        for _ in range(steps):
+            host.update()
+        frames += steps
+
+        dirty = host.render()
+        if not args.headless:
+            pg.display.update(dirty)
+        if args.frames is not None:
+            going = going and frames < args.frames
+        else:
+            main.fpsClock.tick(main.FPS)
+
+    if args.screenshot_dir:
+        os.makedirs(args.screenshot_dir, exist_ok=True)
+        for (i, session) in enumerate(host.sessions, 1):
+            pg.image.save(session.renderer.screen, os.path.join(args.screenshot_dir, SCREENSHOT_FORMAT.format(i)))
+    for session in host.sessions:
+        gamestate = session.gamestate
+        print(f"{session.label}: {gamestate.lesson.name}, score {gamestate.score}")
+        if gamestate.input_recorder:
+            gamestate.input_recorder.close(gamestate.frame_num)
+        if session.midi_thread:
+            session.midi_thread.stop()
+    if progress:
+        for tally in tallies:
+            progress.record_session(tally.result())
+        progress.close()
+
+    pg.midi.quit()
+    pg.quit()
@@ -0,0 +1,186 @@
+import heapq
+import struct
+
+from collections import namedtuple
+
+from lesson_registry import CHORD_SEPARATOR, LessonError
+
+TEXT_SONG_SUFFIX = ".song"
+MIDI_SONG_SUFFIXES = (".mid", ".midi")
+SONG_SUFFIXES = (TEXT_SONG_SUFFIX,) + MIDI_SONG_SUFFIXES
+
+DEFAULT_BPM = 120
+READ_BLOCK_SIZE = 64 * 1024
+
+# Standard MIDI File chunks, big-endian: the header chunk with format, track count and time division, then tracks
+MIDI_HEADER = struct.Struct(">4sIHHH")
+CHUNK_HEADER = struct.Struct(">4sI")
+DEFAULT_TEMPO = 500000  # microseconds per quarter note, i.e. 120 bpm
+DRUM_CHANNEL = 9
+# merged track events are (tick, kind, value) tuples; a tempo change sorts before notes on the same tick
+TEMPO_EVENT = 0
+NOTE_EVENT = 1
+
+# One beat of a song: its time in seconds from the start and the MIDI notes struck on it (more than one for a chord)
+SongEvent = namedtuple("SongEvent", ["seconds", "midi_notes"])
+
+
+class SongError(LessonError):
+    pass
+
+
+NOTE_SEMITONES = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+
+
+# Inverse of pg.midi.midi_to_ansi_note, e.g. "C4" -> 60, "F#3" -> 54
+def ansi_note_to_midi(ansi_note):
+    semitone = NOTE_SEMITONES[ansi_note[0]]
+    octave = ansi_note[1:]
+    while octave[0] in "#b":
+        semitone += 1 if octave[0] == "#" else -1
+        octave = octave[1:]
+    return 12 * (int(octave) + 1) + semitone
+
+
+# Songs are read as they are played rather than loaded up front: both readers are generators of SongEvents in time
+# order, and only read as much of the file as the events asked for so far need.
+def read_song(fname):
+    if fname.lower().endswith(MIDI_SONG_SUFFIXES):
+        return read_midi_song(fname)
+    return read_text_song(fname)
+
+
+# "<beat> <note>[+<note>...]" lines, e.g. "4.5 C4+E4+G4", with beats counted from 0 and in order. A "tempo <bpm>"
+# line changes the tempo from the beat of the line before it; the tempo starts at DEFAULT_BPM.
+def read_text_song(fname):
+    bpm = DEFAULT_BPM
+    (tempo_beat, tempo_seconds) = (0.0, 0.0)
+    last_beat = 0.0
+    with open(fname) as f:
+        for (line_no, line) in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split()
+            if len(fields) != 2:
+                raise SongError(f"{fname}:{line_no}: expected '<beat> <notes>' or 'tempo <bpm>'")
+            try:
+                value = float(fields[1] if fields[0] == "tempo" else fields[0])
+            except ValueError:
+                raise SongError(f"{fname}:{line_no}: not a number") from None
+            if fields[0] == "tempo":
+                if value <= 0:
+                    raise SongError(f"{fname}:{line_no}: tempo must be positive")
+                tempo_seconds += (last_beat - tempo_beat) * 60 / bpm
+                (tempo_beat, bpm) = (last_beat, value)
+                continue
+            if value < last_beat:
+                raise SongError(f"{fname}:{line_no}: beat {fields[0]} is before the previous one")
+            last_beat = value
+            try:
+                midi_notes = [ansi_note_to_midi(note) for note in fields[1].split(CHORD_SEPARATOR)]
+            except (KeyError, IndexError, ValueError):
+                raise SongError(f"{fname}:{line_no}: unknown note in '{fields[1]}'") from None
+            yield SongEvent(tempo_seconds + (value - tempo_beat) * 60 / bpm, midi_notes)
+
+
+# The bytes of length bytes of f from where it is, read a block at a time
+def read_bytes(f, length, block_size=READ_BLOCK_SIZE):
+    while length > 0:
+        block = f.read(min(block_size, length))
+        if not block:
+            return
+        length -= len(block)
+        yield from block
+
+
+def read_varlen(data):
+    value = 0
+    while True:
+        byte = next(data)
+        value = (value << 7) | (byte & 0x7f)
+        if byte < 0x80:
+            return value
+
+
+# A track's tempo changes and note-ons as (tick, kind, value) tuples, read from its own file handle so tracks can be
+# merged lazily. Drums and every other kind of event are skipped; a truncated track just ends early.
+def read_midi_track(fname, offset, length):
+    with open(fname, "rb") as f:
+        f.seek(offset)
+        data = read_bytes(f, length)
+        tick = 0
+        status = None
+        try:
+            while True:
+                tick += read_varlen(data)
+                byte = next(data)
+                if byte == 0xff:  # meta event
+                    meta_type = next(data)
+                    payload = [next(data) for _ in range(read_varlen(data))]
+                    if meta_type == 0x51 and len(payload) == 3:
+                        yield (tick, TEMPO_EVENT, int.from_bytes(bytes(payload), "big"))
+                    elif meta_type == 0x2f:  # end of track
+                        return
+                    continue
+                if byte in (0xf0, 0xf7):  # sysex
+                    for _ in range(read_varlen(data)):
+                        next(data)
+                    continue
+                if byte & 0x80:
+                    status = byte
+                    data1 = next(data)
+                elif status is None:
+                    raise SongError(f"{fname}: track at byte {offset} has data before its first status byte")
+                else:  # running status
+                    data1 = byte
+                kind = status & 0xf0
+                data2 = 0 if kind in (0xc0, 0xd0) else next(data)
+                if kind == 0x90 and data2 and status & 0x0f != DRUM_CHANNEL:
+                    yield (tick, NOTE_EVENT, data1)
+        except StopIteration:
+            return
+
+
+# Only the chunk headers are read up front; the tracks are then merged in tick order as events are asked for, so
+# memory stays flat however long the file is. Note-ons on the same tick, in any track, make up one SongEvent.
+def read_midi_song(fname):
+    with open(fname, "rb") as f:
+        header = f.read(MIDI_HEADER.size)
+        if len(header) < MIDI_HEADER.size or header[:4] != b"MThd":
+            raise SongError(f"{fname}: not a MIDI file")
+        (magic, header_length, midi_format, track_count, division) = MIDI_HEADER.unpack(header)
+        f.seek(CHUNK_HEADER.size + header_length)
+        tracks = []
+        while True:
+            chunk = f.read(CHUNK_HEADER.size)
+            if len(chunk) < CHUNK_HEADER.size:
+                break
+            (chunk_type, length) = CHUNK_HEADER.unpack(chunk)
+            if chunk_type == b"MTrk":
+                tracks.append(read_midi_track(fname, f.tell(), length))
+            f.seek(length, 1)
+
+    if division & 0x8000:  # SMPTE: minus the frames per second in the high byte, ticks per frame in the low one
+        frames_per_second = 256 - (division >> 8)
+        (seconds_per_tick, ticks_per_beat) = (1 / (frames_per_second * (division & 0xff)), None)
+    else:
+        (seconds_per_tick, ticks_per_beat) = (DEFAULT_TEMPO / 1e6 / division, division)
+
+    (last_tick, seconds) = (0, 0.0)
+    chord = None
+    for (tick, kind, value) in heapq.merge(*tracks):
+        seconds += (tick - last_tick) * seconds_per_tick
+        last_tick = tick
+        if kind == TEMPO_EVENT:
+            if ticks_per_beat:
+                seconds_per_tick = value / 1e6 / ticks_per_beat
+            continue
+        if chord and chord.seconds != seconds:
+            yield chord
+            chord = None
+        if chord is None:
+            chord = SongEvent(seconds, [])
+        chord.midi_notes.append(value)
+    if chord:
+        yield chord
@@ -0,0 +1,109 @@
+import hashlib
+import os
+
+import numpy as np
+import pygame as pg
+import pygame.sndarray
+
+import main
+from event_bus import TOPIC_NOTE_PLAYED, TOPIC_NOTE_SPAWNED
+
+SAMPLE_RATE = 44100
+MIXER_BUFFER = 256  # samples; small enough that a note sounds within a few ms of being triggered
+CACHE_DIR = os.path.join(main.main_dir, "__samplecache__")
+CACHE_FORMAT_VERSION = 1
+
+# a soft electric piano: relative amplitudes of the first few harmonics, a short attack and an exponential decay
+HARMONICS = (1.0, 0.5, 0.25, 0.12)
+NOTE_SECONDS = 1.5
+ATTACK_SECONDS = 0.005
+DECAY_SECONDS = 0.4
+RELEASE_SECONDS = 0.05  # faded to silence at the end, so a note that rings out doesn't click
+HEADROOM = 0.5  # leaves room for chords before the mixer clips
+
+
+def midi_frequency(midi_notes):
+    return 440.0 * 2 ** ((np.asarray(midi_notes, dtype=np.float64) - 69) / 12)
+
+
+# One row of 16-bit samples per MIDI note, all rendered in one go
+def render_waveforms(midi_notes, sample_rate=SAMPLE_RATE):
+    t = np.arange(round(NOTE_SECONDS * sample_rate)) / sample_rate
+    phase = 2 * np.pi * midi_frequency(midi_notes)[:, np.newaxis] * t
+    wave = sum(amplitude * np.sin(harmonic * phase) for (harmonic, amplitude) in enumerate(HARMONICS, 1))
+    envelope = np.minimum(t / ATTACK_SECONDS, 1) * np.exp(-t / DECAY_SECONDS) * \
+        np.minimum((NOTE_SECONDS - t) / RELEASE_SECONDS, 1)
+    wave *= envelope * (HEADROOM / sum(HARMONICS))
+    return (wave * np.iinfo(np.int16).max).astype(np.int16)
+
+
+# Rendered waveforms are cached on disk, keyed by everything that goes into them, so later runs just load them
+def load_waveforms(midi_notes, sample_rate=SAMPLE_RATE, cache_dir=CACHE_DIR):
+    key = repr((CACHE_FORMAT_VERSION, sample_rate, HARMONICS, NOTE_SECONDS, ATTACK_SECONDS, DECAY_SECONDS,
+                RELEASE_SECONDS, HEADROOM, tuple(midi_notes)))
+    cache_fname = os.path.join(cache_dir, f"synth-{hashlib.sha1(key.encode()).hexdigest()[:16]}.npy")
+    try:
+        return np.load(cache_fname)
+    except (OSError, ValueError):
+        pass
+    waveforms = render_waveforms(midi_notes, sample_rate)
+    # the cache is an optimisation only, e.g. the game directory may be read-only
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_fname = cache_fname + ".tmp"
+        with open(tmp_fname, "wb") as f:
+            np.save(f, waveforms)
+        os.replace(tmp_fname, cache_fname)
+    except OSError:
+        pass
+    return waveforms
+
+
+# (Re)opens the mixer with a short buffer; pg.init() opens it with a longer, higher latency one
+def init_mixer(sample_rate=SAMPLE_RATE, buffer=MIXER_BUFFER):
+    if pg.mixer.get_init():
+        pg.mixer.quit()
+    pg.mixer.init(sample_rate, -16, 2, buffer)
+
+
+# Plays every pitch on the staff from pre-rendered sounds. Triggering a note picks a mixer channel (stealing the
+# oldest when all are busy), sets its volume from the velocity and starts the sound; mixing happens on SDL's audio
+# thread, so the frame loop never waits on audio.
+class Synth:
+    NUM_CHANNELS = 32
+    ENEMY_NOTE_VELOCITY = 40
+
+    def __init__(self, staff, cache_dir=CACHE_DIR):
+        (sample_rate, size, channels) = pg.mixer.get_init()
+        pg.mixer.set_num_channels(self.NUM_CHANNELS)
+        self.staff = staff
+        midi_notes = sorted(set(staff.midi_notes.values()))
+        waveforms = load_waveforms(midi_notes, sample_rate, cache_dir)
+        self.sounds = [None] * main.MIDI_NOTES
+        for (midi_note, waveform) in zip(midi_notes, waveforms):
+            samples = np.repeat(waveform[:, np.newaxis], channels, axis=1) if channels > 1 else waveform
+            self.sounds[midi_note] = pg.sndarray.make_sound(np.ascontiguousarray(samples))
+
+    def play(self, midi_note, velocity=main.MIDI_MAX_VELOCITY):
+        sound = self.sounds[midi_note]
+        if sound is None:
+            return
+        channel = pg.mixer.find_channel(True)
+        channel.set_volume(velocity / main.MIDI_MAX_VELOCITY)
+        channel.play(sound)
+
+    # sounds the player's notes as they're played, and enemy notes, more quietly, as they spawn
+    def attach(self, bus):
+        bus.subscribe(TOPIC_NOTE_PLAYED, self.play_note_played)
+        bus.subscribe(TOPIC_NOTE_SPAWNED, self.play_note_spawned)
+
+    def detach(self, bus):
+        bus.unsubscribe(TOPIC_NOTE_PLAYED, self.play_note_played)
+        bus.unsubscribe(TOPIC_NOTE_SPAWNED, self.play_note_spawned)
+
+    def play_note_played(self, event):
+        self.play(event.payload.midi_note, event.payload.velocity)
+
+    def play_note_spawned(self, event):
+        for note_height_id in event.payload:
+            self.play(self.staff.midi_notes[note_height_id], self.ENEMY_NOTE_VELOCITY)